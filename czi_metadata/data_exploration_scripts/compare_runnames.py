@@ -7,14 +7,15 @@ CZI_run_id: run ID on CZI
 This script also skips directories with 'figures', 'paper','MK_application', or 'PEET' in the name, as those directories do not
 contain tomogram runs.
 
-Dependencies: cryoet_data_portal, os, sys, csv
+Dependencies: cryoet_data_portal (to refresh the CZI snapshot, see czi_snapshot.py), sys, csv, sqlite3
 pip command to install cryoet_data_portal: pip install -U cryoet-data-portal
 
 Author: Eben Lonsdale
 Date: 24 June 2024
 '''
-from cryoet_data_portal import Client, Dataset
-import os
+from czi_snapshot import load_czi_runs
+from run_tree import czi_name_lookup
+from run_index import open_index, refresh_index, run_names as indexed_run_names
 import sys
 import csv
 # check command line arguments
@@ -25,47 +26,25 @@ if len(sys.argv) != 3:
 dir_to_search = sys.argv[1] # directory to search
 output_file = sys.argv[2] # file to save run names to
 
-# directories that don't contain tomogram runs
-words_to_skip = ['figures', 'paper','mk_application','peet']
-# set to hold run names
-run_names = set()
-# search for run names in the directory
-for dirpath, dirnames, filenames in os.walk(dir_to_search):
-    # skip non-run directories
-    if not any(any(word in dirpart.lower() for word in words_to_skip) for dirpart in dirpath.split(os.sep)) and not dirnames:
-        # what this if statement does is break apart the directory path, make it all lowercase, and checks if any of
-        # the words in words_to_skip are in the directory path. If none of the words are in the path, then it checks
-        # if there are any directories in the current directory. If there are no directories, then this is hopefully a run directory
-        run_name = os.path.basename(dirpath) # get the run name
-        run_names.add(run_name)
-    else: continue
+# set to hold run names, from the persistent index of the tree (see run_index.py): only directories that changed
+# since the last run are listed again, and directories like 'figures' or 'PEET' are never entered
+conn = open_index()
+refresh_index(conn, dir_to_search)
+run_names = indexed_run_names(conn, dir_to_search)
+conn.close()
             
-# now get run names from CZI - this makes sure you get the most up to date list
-client = Client()
-datasets = [] # list to hold dataset objects
-
-for dataset in Dataset.find(client):
-    # get only datasets with Grant Jensen as an author
-    if any(author.name == "Grant Jensen" for author in dataset.authors):
-        datasets.append(dataset)
-
-# get CZI run names and run IDs
-czi_run_names_id = {} # dictionary to associate run names with run IDs
-czi_run_names = [] # array to hold run names
-for dataset in datasets:
-    for run in dataset.runs:
-        czi_run_names_id[run.name] = run.id
-        czi_run_names.append(run.name)
+# now get run names from CZI - the local snapshot is refreshed from the portal when it is a day old, so the list stays up to date
+czi_run_names, czi_ids = load_czi_runs('Grant Jensen')
+czi_run_names_id = {run_name: ids[1] for run_name, ids in czi_ids.items()} # dictionary to associate run names with run IDs
 
 # get overlapping run names
 matching_runs = [] # list for matching run names
+lookup = czi_name_lookup(czi_run_names, run_names) # our run name -> CZI run name, 2 letter names only where the 3 letter one is missing
 
-for run in czi_run_names:
-    two_pattern = run[0:2] + run[3:] # pattern to compare our 2 letter names to CZI's 3 letter names
-    if run in run_names:
-        matching_runs.append([run,run,czi_run_names_id[run]]) 
-    elif two_pattern in run_names:
-        matching_runs.append([two_pattern,run,czi_run_names_id[run]]) 
+for run in sorted(run_names):
+    czi_run = lookup.get(run)
+    if czi_run is not None:
+        matching_runs.append([run,czi_run,czi_run_names_id[czi_run]])
 
 with open(output_file, 'a', newline = '') as f1:
     writer1 = csv.writer(f1)
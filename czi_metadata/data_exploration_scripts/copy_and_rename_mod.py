@@ -31,10 +31,10 @@
 # copy_and_rename_mod_files(source_csv, destination_dir)
 
 import os
-import shutil
 import pandas as pd
+from staging import stage_files
 
-def copy_and_rename_mod_files(source_csv, destination_dir):
+def copy_and_rename_mod_files(source_csv, destination_dir, link=False):
     # Read the directory paths from the CSV file
     df = pd.read_csv(source_csv)
     directories = df['Path'].tolist()
@@ -44,21 +44,19 @@ def copy_and_rename_mod_files(source_csv, destination_dir):
     # Create a mapping from sc_run_name to CZI_run_name
     sc_to_czi_mapping = dict(zip(sc_run_names, czi_run_names))
 
-    # Create the destination directory if it does not exist
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
-
-    # Loop through each directory and process the .mod files
+    # Plan every copy first: each directory's MS.mod, renamed with the CZI run name
+    copies = []
     for dir_path, sc_run_name in zip(directories, sc_run_names):
-        for filename in os.listdir(dir_path):
-            if filename == 'MS.mod':
-                source_file = os.path.join(dir_path, filename)
-                # Prepare new file name by using CZI_run_name
-                new_filename = f"{sc_to_czi_mapping[sc_run_name]}_{filename}"
-                destination_file = os.path.join(destination_dir, new_filename)
-                # Copy and rename the file to the new destination
-                shutil.copy2(source_file, destination_file)
-                print(f"Copied and renamed {source_file} to {destination_file}")
+        source_file = os.path.join(dir_path, 'MS.mod')
+        if os.path.isfile(source_file):
+            new_filename = f"{sc_to_czi_mapping[sc_run_name]}_MS.mod"
+            copies.append((source_file, os.path.join(destination_dir, new_filename)))
+
+    # Copy in parallel, skipping files already copied with the same size and mtime
+    os.makedirs(destination_dir, exist_ok=True)
+    counts = stage_files(copies, os.path.join(destination_dir, 'staged_files.tsv'), link=link)
+    print(f"Copied and renamed {counts['copied'] + counts['linked']} files to {destination_dir} "
+          f"({counts['unchanged']} already up to date, {counts['failed']} failed)")
 
 # Specify the CSV file path and the destination directory
 source_csv = 'MS.mod_directories.csv'
@@ -0,0 +1,129 @@
+'''
+Local snapshot of the CZI (CryoET Data Portal) runs of one author's datasets.
+Dependencies: cryoet_data_portal (only when the snapshot is refreshed), sqlite3
+
+Description:
+Looking up run names used to walk every dataset on the portal, check its authors on the client, and then fetch
+each dataset's runs one relation at a time. Here the author filter runs on the server (a DatasetAuthor query),
+the runs of all the datasets come back in one bulk query, and the result is kept in a small SQLite file. Later
+calls read the snapshot and only go back to the portal once it is older than 'max_age' seconds. A refresh is
+incremental: only the datasets that are new or whose last-modified date changed have their runs fetched again,
+and runs of datasets that disappeared are dropped. If the portal can't be reached, a stale snapshot is used.
+
+Usage:
+python czi_snapshot.py [--author "Grant Jensen"] [--refresh]
+Prints how many runs the snapshot holds. Use --refresh to update it now regardless of its age.
+'''
+import os
+import sys
+import time
+import sqlite3
+
+DEFAULT_SNAPSHOT = os.path.expanduser('~/.cache/czi_metadata/czi_snapshot.sqlite')
+DEFAULT_AUTHOR = 'Grant Jensen'
+DEFAULT_MAX_AGE = 24 * 60 * 60  # one day
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (dataset_id INTEGER, author TEXT, last_modified TEXT, PRIMARY KEY (dataset_id, author));
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, run_name TEXT, dataset_id INTEGER);
+CREATE INDEX IF NOT EXISTS runs_by_dataset ON runs (dataset_id);
+CREATE TABLE IF NOT EXISTS refreshes (author TEXT PRIMARY KEY, refreshed_at REAL);
+'''
+
+
+def portal_client():
+    # check for non-standard depency
+    try:
+        from cryoet_data_portal import Client
+    except ImportError:
+        print("Missing dependency: cryoet_data_portal. Please install it using\npip install -U cryoet-data-portal\nbefore refreshing the CZI snapshot.")
+        sys.exit(1)
+    return Client()
+
+
+def fetch_author_datasets(client, author):
+    '''{dataset_id: last modified date} of every dataset with 'author' as an author, filtered on the server.'''
+    from cryoet_data_portal import Dataset, DatasetAuthor
+    dataset_ids = sorted({entry.dataset_id for entry in DatasetAuthor.find(client, [DatasetAuthor.name == author])})
+    if not dataset_ids:
+        return dict()
+    return {dataset.id: str(dataset.last_modified_date)
+            for dataset in Dataset.find(client, [Dataset.id._in(dataset_ids)])}
+
+
+def fetch_runs(client, dataset_ids):
+    '''(run_id, run_name, dataset_id) of every run in 'dataset_ids', in one bulk query.'''
+    from cryoet_data_portal import Run
+    if not dataset_ids:
+        return []
+    return [(run.id, run.name, run.dataset_id) for run in Run.find(client, [Run.dataset_id._in(sorted(dataset_ids))])]
+
+
+def open_snapshot(snapshot_path=DEFAULT_SNAPSHOT):
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(snapshot_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def refresh_snapshot(conn, author=DEFAULT_AUTHOR, client=None):
+    '''Bring the snapshot of 'author's runs up to date, fetching runs only for new or modified datasets.'''
+    if client is None:
+        client = portal_client()
+    remote = fetch_author_datasets(client, author)
+    local = dict(conn.execute('SELECT dataset_id, last_modified FROM datasets WHERE author = ?', (author,)))
+    changed = [dataset_id for dataset_id, modified in remote.items() if local.get(dataset_id) != modified]
+    removed = [dataset_id for dataset_id in local if dataset_id not in remote]
+    runs = fetch_runs(client, changed)
+    with conn:
+        conn.executemany('DELETE FROM datasets WHERE dataset_id = ? AND author = ?',
+                         [(dataset_id, author) for dataset_id in removed])
+        conn.executemany('DELETE FROM runs WHERE dataset_id = ?', [(dataset_id,) for dataset_id in changed])
+        # runs of a dropped dataset stay if another author's snapshot still lists the dataset
+        conn.executemany('DELETE FROM runs WHERE dataset_id = ? AND NOT EXISTS '
+                         '(SELECT 1 FROM datasets WHERE datasets.dataset_id = runs.dataset_id)',
+                         [(dataset_id,) for dataset_id in removed])
+        conn.executemany('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)',
+                         [(dataset_id, author, remote[dataset_id]) for dataset_id in changed])
+        conn.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)', runs)
+        conn.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (author, time.time()))
+    print(f"CZI snapshot: {len(changed)} datasets updated, {len(removed)} removed, {len(runs)} runs fetched.")
+
+
+def load_czi_runs(author=DEFAULT_AUTHOR, snapshot_path=DEFAULT_SNAPSHOT, max_age=DEFAULT_MAX_AGE, refresh=False,
+                  client=None):
+    '''
+    Return (czi_run_names, czi_ids) for 'author's datasets, in the same form get_czi_runnames always returned:
+    a set of run names and a dictionary mapping each run name to [dataset ID, run ID].
+    The snapshot is refreshed first if it is older than 'max_age' seconds or 'refresh' is set.
+    '''
+    conn = open_snapshot(snapshot_path)
+    try:
+        row = conn.execute('SELECT refreshed_at FROM refreshes WHERE author = ?', (author,)).fetchone()
+        if refresh or row is None or time.time() - row[0] > max_age:
+            try:
+                refresh_snapshot(conn, author, client)
+            except Exception as e:
+                if row is None:
+                    raise
+                print(f"Could not refresh the CZI snapshot ({e}); using the one from {time.ctime(row[0])}.")
+        czi_ids = dict()
+        query = '''SELECT runs.run_name, runs.dataset_id, runs.run_id FROM runs
+                   JOIN datasets ON runs.dataset_id = datasets.dataset_id WHERE datasets.author = ?
+                   ORDER BY runs.run_id'''
+        for run_name, dataset_id, run_id in conn.execute(query, (author,)):
+            czi_ids[run_name] = [dataset_id, run_id]
+    finally:
+        conn.close()
+    return set(czi_ids), czi_ids
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Update and inspect the local snapshot of CZI run names.')
+    parser.add_argument('--author', default=DEFAULT_AUTHOR, help=f'Dataset author to snapshot (default: {DEFAULT_AUTHOR}).')
+    parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT, help=f'Snapshot file (default: {DEFAULT_SNAPSHOT}).')
+    parser.add_argument('--refresh', action='store_true', help='Refresh from the portal even if the snapshot is recent.')
+    args = parser.parse_args()
+    czi_run_names, czi_ids = load_czi_runs(args.author, args.snapshot, refresh=args.refresh)
+    print(f"{len(czi_run_names)} runs in {len({ids[0] for ids in czi_ids.values()})} datasets by {args.author}.")
@@ -67,31 +67,23 @@
 #         print(f"No directories found containing {target_mod_file}.")
 
 
-import os
 import pandas as pd
 from collections import Counter, defaultdict
 import matplotlib.pyplot as plt
+from czi_snapshot import load_czi_runs
+from run_index import open_index, refresh_index, update_czi_names, matching_runs_with_file
 
-def find_matching_directories(root_path, directory_names):
-    """Find directories that match any of the names in 'directory_names' starting from 'root_path'."""
-    matched_directories = []
-    for root, dirs, files in os.walk(root_path):
-        for dir_name in dirs:
-            if dir_name in directory_names:
-                matched_directories.append(os.path.join(root, dir_name))
-    return matched_directories
-
-def find_mod_files_and_directories(directories):
-    """Given a list of directories, find all .mod files within them and track directories."""
+def find_mod_files_and_directories(conn, root_path):
+    """Find all .mod files in the run directories under 'root_path' that match CZI, from the index.
+    Returns the counts per file name, the directories per file name, and each directory's (sc, CZI) run names."""
     mod_files = Counter()
     directories_for_files = defaultdict(set)
-    for directory in directories:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                if file.endswith('.mod'):
-                    mod_files[file] += 1
-                    directories_for_files[file].add(root)
-    return mod_files, directories_for_files
+    run_names_for_dirs = dict()
+    for path, file, sc_run_name, czi_run_name, _, _ in matching_runs_with_file(conn, '*.mod', root_path):
+        mod_files[file] += 1
+        directories_for_files[file].add(path)
+        run_names_for_dirs[path] = (sc_run_name, czi_run_name)
+    return mod_files, directories_for_files, run_names_for_dirs
 
 def plot_histogram(file_counts):
     """Plot a histogram from a Counter of file occurrences."""
@@ -108,18 +100,19 @@ def plot_histogram(file_counts):
     plt.savefig('mod_file_histogram_by_name.png', format='png', dpi=300)
     plt.show()
 
-# Read the directory names from the CSV
-df = pd.read_csv('matching_runs_d1.csv')
-directory_names = set(df['sc_run_name'].values)  # Convert to set for faster lookup
-
-# Create a mapping from sc_run_name to CZI_run_name
-sc_to_czi_mapping = dict(zip(df['sc_run_name'], df['CZI_run_name']))
-
 # Main variables
 root_search_path = "../compute/TomoDB1_d1"
 # Process
-matched_dirs = find_matching_directories(root_search_path, directory_names)
-mod_files_counts, directories_for_files = find_mod_files_and_directories(matched_dirs)
+# the persistent index of the tree (see run_index.py) knows the directories and every .mod file in them, and only
+# directories that changed since the last run are listed again. Like the other scripts, it does not enter
+# directories named like run_tree.WORDS_TO_SKIP (e.g. PEET folders), so .mod files in those are not counted.
+# The runs matching CZI come from the local CZI snapshot instead of matching_runs_d1.csv.
+conn = open_index()
+refresh_index(conn, root_search_path)
+czi_run_names, czi_ids = load_czi_runs('Grant Jensen')
+update_czi_names(conn, czi_ids)
+mod_files_counts, directories_for_files, run_names_for_dirs = find_mod_files_and_directories(conn, root_search_path)
+conn.close()
 
 view_only = False
 if view_only:
@@ -130,8 +123,8 @@ else:
     if target_mod_file in directories_for_files:
         directory_list = list(directories_for_files[target_mod_file])
         
-        # Create a list of tuples containing the original and corresponding CZI names and paths
-        output_data = [(dir_path, os.path.basename(dir_path), sc_to_czi_mapping.get(os.path.basename(dir_path), os.path.basename(dir_path))) for dir_path in directory_list]
+        # Create a list of tuples containing the paths and the sc and CZI names of the runs they belong to
+        output_data = [(dir_path, *run_names_for_dirs[dir_path]) for dir_path in directory_list]
         
         # Create a DataFrame with the path, sc_run_name, and CZI_run_name
         df_directories = pd.DataFrame(output_data, columns=['Path', 'sc_run_name', 'CZI_run_name'])
@@ -0,0 +1,233 @@
+'''
+Persistent SQLite index of the supercomputer run tree, shared by the CZI metadata scripts.
+Dependencies: os, sqlite3, cryoet_data_portal (only when the CZI snapshot is refreshed)
+
+Description:
+compare_runnames.py, look_for_mod_in_czi_common.py, copy_and_rename_mod.py and czi_data_prep_pipeline.py all need
+the same facts: which run directories exist, which files (.mod annotations) they hold, and which CZI run each one
+corresponds to. Instead of walking the tree again and passing the answers along in CSVs, refresh_index records
+every directory and file (with sizes and mtimes) in a SQLite database. On a refresh, a directory whose mtime is
+unchanged is not listed again: its subdirectories are taken from the index, and its indexed files are only stat'ed,
+so that a file rewritten in place (which does not change the directory's mtime) gets its new size and mtime. A
+refresh of an unchanged tree therefore costs one stat per directory and file, but no listings. Directories named
+like run_tree.WORDS_TO_SKIP are not indexed.
+
+update_czi_names stores the sc -> CZI run name mapping (see czi_snapshot.py and run_tree.czi_name_lookup), and
+the query functions answer questions like "all runs containing MS.mod that match CZI" with a single SQL query.
+compare_runnames.py, look_for_mod_in_czi_common.py and czi_data_prep_pipeline.py refresh the index of their search
+directory and query it instead of walking the tree. File names in the queries can be fnmatch-style patterns
+('*.mod'), matched with SQLite's GLOB.
+
+Usage:
+python run_index.py <directory to index> [--db INDEX] [--file MS.mod] [--csv MS.mod_directories.csv]
+Refreshes the index and the CZI names, then lists the runs holding --file that match CZI (optionally as a CSV
+with the Path, sc_run_name and CZI_run_name columns that copy_and_rename_mod.py reads).
+'''
+import os
+import sqlite3
+from run_tree import WORDS_TO_SKIP, skip_directory, czi_name_lookup
+
+DEFAULT_INDEX = os.path.expanduser('~/.cache/czi_metadata/run_index.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, name TEXT, mtime_ns INTEGER, is_run INTEGER);
+CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS dirs_by_name ON dirs (name);
+CREATE TABLE IF NOT EXISTS files (dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (dir, name));
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name);
+CREATE TABLE IF NOT EXISTS czi_names (sc_name TEXT PRIMARY KEY, czi_name TEXT, dataset_id INTEGER, run_id INTEGER);
+'''
+
+
+def open_index(index_path=DEFAULT_INDEX):
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(index_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def under(root_dir, column):
+    '''SQL condition (and its parameters) for 'column' being 'root_dir' or a path below it.'''
+    prefix = root_dir.rstrip(os.sep) + os.sep
+    return f'({column} = ? OR substr({column}, 1, ?) = ?)', (root_dir, len(prefix), prefix)
+
+
+def remove_subtree(conn, path):
+    '''Drop a directory and everything indexed below it.'''
+    condition, params = under(path, 'dir')
+    conn.execute(f'DELETE FROM files WHERE {condition}', params)
+    condition, params = under(path, 'path')
+    conn.execute(f'DELETE FROM dirs WHERE {condition}', params)
+
+
+def list_directory(dirpath, words_to_skip):
+    '''One scandir: (subdirectories to index, whether there are any subdirectories at all, [(name, size, mtime_ns)]).'''
+    subdirs = []
+    has_subdirs = False
+    files = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                has_subdirs = True
+                if not skip_directory(entry.name, words_to_skip):
+                    subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return sorted(subdirs), has_subdirs, files
+
+
+def update_files(conn, dirpath):
+    '''Stat the indexed files of an unchanged directory and update the rows of files rewritten in place.'''
+    updated = 0
+    for name, size, mtime_ns in conn.execute('SELECT name, size, mtime_ns FROM files WHERE dir = ?',
+                                             (dirpath,)).fetchall():
+        try:
+            stat = os.stat(os.path.join(dirpath, name))
+        except OSError:
+            conn.execute('DELETE FROM files WHERE dir = ? AND name = ?', (dirpath, name))
+            updated += 1
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            conn.execute('UPDATE files SET size = ?, mtime_ns = ? WHERE dir = ? AND name = ?',
+                         (stat.st_size, stat.st_mtime_ns, dirpath, name))
+            updated += 1
+    return updated
+
+
+def refresh_index(conn, root_dir, words_to_skip=WORDS_TO_SKIP):
+    '''
+    Bring the index of 'root_dir' up to date, listing only directories whose mtime changed.
+    Returns (directories listed, directories reused from the index, files updated in reused directories).
+    '''
+    root_dir = os.path.abspath(root_dir)
+    listed = 0
+    reused = 0
+    updated = 0
+    with conn:
+        stack = [(root_dir, os.path.dirname(root_dir))]
+        while stack:
+            dirpath, parent = stack.pop()
+            row = conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (dirpath,)).fetchone()
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+                if row is not None and row[0] == mtime_ns:
+                    subdirs = [path for path, in conn.execute('SELECT path FROM dirs WHERE parent = ? ORDER BY path',
+                                                               (dirpath,))]
+                    updated += update_files(conn, dirpath)
+                    reused += 1
+                else:
+                    subdirs, has_subdirs, files = list_directory(dirpath, words_to_skip)
+                    listed += 1
+            except OSError as e:
+                print(f"Failed to list {dirpath}: {e}")
+                remove_subtree(conn, dirpath)
+                continue
+            if row is None or row[0] != mtime_ns:
+                # forget subdirectories that are gone, then record this directory's own listing
+                known = [path for path, in conn.execute('SELECT path FROM dirs WHERE parent = ?', (dirpath,))]
+                for path in set(known) - set(subdirs):
+                    remove_subtree(conn, path)
+                conn.execute('DELETE FROM files WHERE dir = ?', (dirpath,))
+                conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?)',
+                                 [(dirpath, name, size, mtime) for name, size, mtime in files])
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                             (dirpath, parent, os.path.basename(dirpath), mtime_ns, int(not has_subdirs)))
+            stack.extend((path, dirpath) for path in reversed(subdirs))
+    return listed, reused, updated
+
+
+def update_czi_names(conn, czi_ids):
+    '''Store which sc run names match which CZI runs; 'czi_ids' maps CZI run names to [dataset ID, run ID].'''
+    lookup = czi_name_lookup(czi_ids)
+    with conn:
+        conn.execute('DELETE FROM czi_names')
+        conn.executemany('INSERT INTO czi_names VALUES (?, ?, ?, ?)',
+                         [(sc_name, czi_name, czi_ids[czi_name][0], czi_ids[czi_name][1])
+                          for sc_name, czi_name in lookup.items()])
+
+
+def run_names(conn, root_dir=None):
+    '''Names of all run (leaf) directories, optionally only those under 'root_dir'.'''
+    if root_dir is None:
+        rows = conn.execute('SELECT DISTINCT name FROM dirs WHERE is_run = 1')
+    else:
+        condition, params = under(os.path.abspath(root_dir), 'path')
+        rows = conn.execute(f'SELECT DISTINCT name FROM dirs WHERE is_run = 1 AND {condition}', params)
+    return {name for name, in rows}
+
+
+def runs_with_file(conn, pattern):
+    '''(directory, file name, size, mtime_ns) of every indexed file matching 'pattern'.'''
+    return conn.execute('SELECT dir, name, size, mtime_ns FROM files WHERE name GLOB ? ORDER BY dir, name',
+                        (pattern,)).fetchall()
+
+
+def preferred_name(root_dir):
+    '''
+    SQL condition (and its parameters) that drops a 2-letter match 'czi.sc_name' when a run with the exact CZI name
+    exists too, optionally only counting runs below 'root_dir' (see run_tree.czi_name_lookup).
+    '''
+    condition, params = under(os.path.abspath(root_dir), 'exact.path') if root_dir is not None else ('1', ())
+    return (f'''(czi.sc_name = czi.czi_name OR NOT EXISTS (
+                   SELECT 1 FROM dirs AS exact WHERE exact.name = czi.czi_name AND exact.is_run = 1 AND {condition}))''',
+            params)
+
+
+def matching_runs(conn, root_dir=None):
+    '''
+    (path, sc_run_name, CZI_run_name, dataset ID, run ID) of every indexed run (leaf) directory whose name matches
+    CZI, optionally only those below 'root_dir'.
+    '''
+    condition, params = under(os.path.abspath(root_dir), 'dirs.path') if root_dir is not None else ('1', ())
+    preferred, preferred_params = preferred_name(root_dir)
+    return conn.execute(f'''SELECT dirs.path, dirs.name, czi.czi_name, czi.dataset_id, czi.run_id
+                            FROM dirs JOIN czi_names AS czi ON dirs.name = czi.sc_name
+                            WHERE dirs.is_run = 1 AND {condition} AND {preferred}
+                            ORDER BY dirs.path''', params + preferred_params).fetchall()
+
+
+def matching_runs_with_file(conn, pattern, root_dir=None):
+    '''
+    Like matching_runs, for the files matching 'pattern' that sit in a matching run directory, one row per file:
+    (run path, file name, sc_run_name, CZI_run_name, dataset ID, run ID). Runs are leaf directories, as in
+    run_names and run_tree.scan_run_tree, so a file always sits in its run directory itself and the lookup is an
+    equality join on the indexed directory path.
+    '''
+    condition, params = under(os.path.abspath(root_dir), 'dirs.path') if root_dir is not None else ('1', ())
+    preferred, preferred_params = preferred_name(root_dir)
+    return conn.execute(f'''SELECT dirs.path, files.name, dirs.name, czi.czi_name, czi.dataset_id, czi.run_id
+                            FROM files
+                            JOIN dirs ON dirs.path = files.dir
+                            JOIN czi_names AS czi ON czi.sc_name = dirs.name
+                            WHERE files.name GLOB ? AND dirs.is_run = 1 AND {condition} AND {preferred}
+                            ORDER BY dirs.path, files.name''', (pattern,) + params + preferred_params).fetchall()
+
+
+if __name__ == '__main__':
+    import csv
+    import time
+    import argparse
+    from czi_snapshot import load_czi_runs
+    parser = argparse.ArgumentParser(description='Index the run tree and list runs holding a file that match CZI.')
+    parser.add_argument('root_dir', help='Directory to index.')
+    parser.add_argument('--db', default=DEFAULT_INDEX, help=f'Index file (default: {DEFAULT_INDEX}).')
+    parser.add_argument('--file', default='MS.mod', help='File to look for (default: MS.mod).')
+    parser.add_argument('--csv', default=None, help='Write the matches as a CSV with Path, sc_run_name, CZI_run_name.')
+    args = parser.parse_args()
+
+    conn = open_index(args.db)
+    start = time.time()
+    listed, reused, updated = refresh_index(conn, args.root_dir)
+    print(f"Indexed {args.root_dir}: {listed} directories listed, {reused} unchanged ({updated} files updated), "
+          f"in {time.time() - start:.1f} s")
+    czi_run_names, czi_ids = load_czi_runs()
+    update_czi_names(conn, czi_ids)
+    rows = matching_runs_with_file(conn, args.file, args.root_dir)
+    print(f"{len(rows)} runs with {args.file} match CZI")
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Path', 'sc_run_name', 'CZI_run_name'])
+            writer.writerows((path, sc_name, czi_name) for path, _, sc_name, czi_name, _, _ in rows)
+    conn.close()
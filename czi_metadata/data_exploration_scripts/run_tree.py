@@ -0,0 +1,113 @@
+'''
+Single-pass scan of the supercomputer run tree for the CZI metadata scripts.
+Dependencies: os, fnmatch, collections
+
+Description:
+The pipeline used to walk the search directory three times (run names, matching directories, then the target
+files under every match), and compare_runnames.py and look_for_mod_in_czi_common.py walked the same trees again.
+On the supercomputer's file system the directory listings are the slow part, so scan_run_tree lists every
+directory exactly once with os.scandir, never descends into directories named like words_to_skip, and records in
+that one pass the run names (leaf directories), every directory's name, and the directories holding the files
+we look for. Matching against CZI names and finding target files under the matched directories then happen in
+memory.
+
+sc run names relate to CZI run names either exactly or through the 2-letter/3-letter rule (our 'ab123' is CZI's
+'abc123' with the third letter dropped), and the exact name is preferred when both exist. czi_name_lookup
+precomputes that mapping once, so matching a run name is a single dictionary lookup.
+'''
+import os
+import fnmatch
+from collections import defaultdict
+from typing import NamedTuple
+
+# directories that don't contain tomogram runs
+WORDS_TO_SKIP = ['figures', 'paper', 'mk_application', 'peet']
+
+
+class RunTree(NamedTuple):
+    '''What one scan of a search directory found.'''
+    dirs: list          # (path, name) of every directory below the search directory, in scan order
+    run_names: set      # names of the leaf directories, which are the runs
+    target_dirs: dict   # {file name: set of directories that hold a file of that name} for the target patterns
+
+
+def skip_directory(name, words_to_skip):
+    lowered = name.lower()
+    return any(word in lowered for word in words_to_skip)
+
+
+def scan_run_tree(search_dir, target_files=(), words_to_skip=WORDS_TO_SKIP):
+    '''
+    List every directory under 'search_dir' once, pruning directories whose name contains any of 'words_to_skip'.
+    'target_files' are file names or fnmatch patterns (e.g. 'MS.mod' or '*.mod') whose locations are recorded.
+    '''
+    dirs = []
+    run_names = set()
+    target_dirs = defaultdict(set)
+    stack = [search_dir]
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+        has_subdirs = False
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        has_subdirs = True
+                        if not skip_directory(entry.name, words_to_skip):
+                            subdirs.append(entry.path)
+                    elif any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in target_files):
+                        target_dirs[entry.name].add(dirpath)
+        except OSError as e:
+            print(f"Failed to list {dirpath}: {e}")
+            continue
+        if dirpath != search_dir:
+            dirs.append((dirpath, os.path.basename(dirpath)))
+        # a run is a directory without subdirectories (skipped ones count, e.g. a run with a PEET folder is not a leaf)
+        if not has_subdirs:
+            run_names.add(os.path.basename(dirpath))
+        stack.extend(sorted(subdirs, reverse=True))
+    return RunTree(dirs, run_names, dict(target_dirs))
+
+
+def czi_name_lookup(czi_run_names, sc_run_names=None):
+    '''
+    {sc run name: CZI run name} for every name a supercomputer run could have. An exact name always wins over
+    the 2-letter form of another CZI name. Given the 'sc_run_names' that exist, a CZI run is only matched through
+    its 2-letter form when its exact name is not among them (if both 'abc123' and 'ab123' exist, only 'abc123'
+    matches).
+    '''
+    lookup = dict()
+    for czi_run in czi_run_names:
+        two_pattern = czi_run[0:2] + czi_run[3:] # pattern to compare our 2 letter names to CZI's 3 letter names
+        if sc_run_names is None or czi_run not in sc_run_names:
+            lookup.setdefault(two_pattern, czi_run)
+    for czi_run in czi_run_names:
+        lookup[czi_run] = czi_run
+    return lookup
+
+
+def nearest_match(dirpath, matched_dirs):
+    '''The closest of 'matched_dirs' that is 'dirpath' itself or one of its parents, or None.'''
+    while True:
+        if dirpath in matched_dirs:
+            return dirpath
+        parent = os.path.dirname(dirpath)
+        if parent == dirpath:
+            return None
+        dirpath = parent
+
+
+def files_under(tree, matched_dirs, pattern):
+    '''
+    {file name: directories holding it} for the files matching 'pattern' (a file name or fnmatch pattern, as given
+    to scan_run_tree) that are inside (or are) one of 'matched_dirs', from an earlier scan.
+    '''
+    matched_dirs = set(matched_dirs)
+    found = dict()
+    for file_name, dirpaths in tree.target_dirs.items():
+        if fnmatch.fnmatchcase(file_name, pattern):
+            dirs = {dirpath for dirpath in dirpaths if nearest_match(dirpath, matched_dirs)}
+            if dirs:
+                found[file_name] = dirs
+    return found
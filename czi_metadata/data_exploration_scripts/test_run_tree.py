@@ -0,0 +1,41 @@
+'''
+Tests for matching supercomputer run names to CZI run names in run_tree.py and run_index.py.
+
+Usage:
+python -m pytest test_run_tree.py
+
+Dependencies: pytest
+'''
+import os
+from run_tree import czi_name_lookup
+from run_index import open_index, refresh_index, update_czi_names, matching_runs, matching_runs_with_file
+
+CZI_IDS = {'abc123': [10, 1], 'xyz456': [10, 2]}
+
+
+def make_runs(root, names):
+    for name in names:
+        os.makedirs(root / 'dataset' / name)
+        (root / 'dataset' / name / 'MS.mod').write_bytes(b'')
+
+
+def test_lookup_prefers_the_exact_name():
+    lookup = czi_name_lookup(CZI_IDS, {'abc123', 'ab123', 'xy456'})
+    assert lookup.get('abc123') == 'abc123'
+    assert lookup.get('ab123') is None
+    # without the exact name, the 2-letter name still matches
+    assert lookup.get('xy456') == 'xyz456'
+    assert czi_name_lookup(CZI_IDS)['ab123'] == 'abc123'
+
+
+def test_index_prefers_the_exact_name(tmp_path):
+    make_runs(tmp_path, ['abc123', 'ab123', 'xy456'])
+    conn = open_index(str(tmp_path / 'index.sqlite'))
+    refresh_index(conn, str(tmp_path / 'dataset'))
+    update_czi_names(conn, CZI_IDS)
+    root = str(tmp_path / 'dataset')
+    assert [(name, czi_name) for _, name, czi_name, _, _ in matching_runs(conn, root)] == \
+        [('abc123', 'abc123'), ('xy456', 'xyz456')]
+    assert [(os.path.basename(path), czi_name) for path, _, _, czi_name, _, _ in
+            matching_runs_with_file(conn, '*.mod', root)] == [('abc123', 'abc123'), ('xy456', 'xyz456')]
+    conn.close()
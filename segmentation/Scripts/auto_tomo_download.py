@@ -1,19 +1,33 @@
-from cryoet_data_portal import Client, Run, Tomogram
 import sys
-import os
+import argparse
+from tomo_download import download_runs, portal_resolver, static_resolver
 
-client = Client()
-# IDs for run to download
-datasetid = sys.argv[1]
-runid = sys.argv[2]
-# get correct run and download it
-run = Run.find(client, query_filters=[Run.id == runid, Run.dataset.id == datasetid])[0]
-tomoid = run.tomogram_voxel_spacings[0].tomograms[0].id
-tomogram = Tomogram.get_by_id(client, tomoid)
-tomogram.download_mrcfile()
+# where tomograms are stored, as dataset_<id>/run_<id>.mrc
+STORE_DIR = '/Users/mward19/Documents/Segmentation/tomogram_seg/raw_tomograms'
 
-# rename and move the file
-file_path = '/Users/mward19/Documents/Segmentation/tomogram_seg/raw_tomograms/dataset_'+datasetid+'/run_'+runid+'.mrc'
-os.rename(tomogram.name+'.mrc',file_path)
-# so you can get the file name in bash as a variable
-print(file_path)
\ No newline at end of file
+parser = argparse.ArgumentParser(description='Download tomograms from the CryoET Data Portal.')
+parser.add_argument('ids', nargs='*', help='Dataset and run IDs, alternating: DATASET RUN [DATASET RUN ...]')
+parser.add_argument('--pairs', help='File with one "dataset_id run_id" pair per line.')
+parser.add_argument('--store', default=STORE_DIR, help=f'Directory to store tomograms in (default: {STORE_DIR}).')
+parser.add_argument('-j', '--workers', type=int, default=4, help='Number of concurrent downloads (default: 4).')
+parser.add_argument('--base-url', help='Download from this HTTP server (laid out like the store) instead of the portal.')
+args = parser.parse_args()
+
+# IDs for runs to download
+if len(args.ids) % 2:
+    parser.error('IDs must come in DATASET RUN pairs')
+pairs = list(zip(args.ids[0::2], args.ids[1::2]))
+if args.pairs:
+    with open(args.pairs) as f:
+        pairs += [tuple(line.split()[:2]) for line in f if line.strip() and not line.startswith('#')]
+if not pairs:
+    parser.error('no dataset/run pairs given')
+
+resolver = static_resolver(args.base_url) if args.base_url else portal_resolver
+paths = download_runs(pairs, args.store, resolver, args.workers)
+# so you can get the file names in bash as a variable
+requested = [(int(dataset_id), int(run_id)) for dataset_id, run_id in pairs]
+for pair in requested:
+    if pair in paths:
+        print(paths[pair])
+sys.exit(0 if all(pair in paths for pair in requested) else 1)
@@ -0,0 +1,156 @@
+'''
+One entry point for all the segmentation format converters, for many files at once.
+
+Give it any mix of files and directories and a target format. Directories are searched, not recursively, for the
+files that can be converted to the target; without --format the target is inferred from each input (.mrc/.rec ->
+.mha for ITK-SNAP, .mha -> .npy) and directories only contribute tomograms. Conversions run on a process pool,
+so SimpleITK/h5py are imported once per worker rather than once per file, and outputs that are newer than
+their input are skipped. Each finished file is reported with its throughput.
+
+Usage:
+python convert.py dataset_10067 [more files or directories] [-f mha|nii|h5|pyramid|npy] [-o OUTPUT_DIR] [-j WORKERS]
+
+Dependencies: numpy, mrcfile, and h5py (h5, pyramid) or SimpleITK (.mha -> npy) for the chosen formats
+'''
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# target formats each kind of input can be converted to; the first is the default
+TARGETS = {'.mrc': ('mha', 'nii', 'h5', 'pyramid'), '.rec': ('mha', 'nii', 'h5', 'pyramid'), '.mha': ('npy',)}
+OUTPUT_EXTENSIONS = {'mha': '.mha', 'nii': '.nii', 'h5': '.hdf5', 'pyramid': '_pyramid.hdf5', 'npy': '.npy'}
+
+
+def output_path_for(input_path, target, output_dir=None):
+    '''Where the conversion of 'input_path' to 'target' is written: next to the input unless output_dir is given.'''
+    base = os.path.splitext(os.path.basename(input_path))[0] + OUTPUT_EXTENSIONS[target]
+    return os.path.join(output_dir if output_dir is not None else os.path.dirname(input_path), base)
+
+
+def is_up_to_date(input_path, output_path):
+    '''True if the output exists and is at least as new as the input.'''
+    try:
+        return os.stat(output_path).st_mtime_ns >= os.stat(input_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def convert_one(input_path, output_path, target):
+    '''Run one conversion in a worker. Returns the elapsed time in seconds.'''
+    # imported here so each worker only loads the libraries for the formats it actually writes
+    start = time.time()
+    output_dir = os.path.dirname(output_path) or '.'
+    if target == 'mha':
+        from mrc_to_mha import convert_mrc_to_mha
+        convert_mrc_to_mha(input_path, output_dir)
+    elif target == 'nii':
+        from mrc_to_nii import convert_mrc_to_nii
+        convert_mrc_to_nii(input_path, output_dir)
+    elif target == 'h5':
+        from convert_mrc_to_hdf5 import convert_mrc_to_hdf5
+        convert_mrc_to_hdf5(input_path, output_path)
+    elif target == 'pyramid':
+        from convert_mrc_to_hdf5 import convert_mrc_to_pyramid
+        convert_mrc_to_pyramid(input_path, output_path)
+    elif target == 'npy':
+        from mha_to_np import convert_mha_to_numpy
+        convert_mha_to_numpy(input_path, output_path)
+    else:
+        raise ValueError(f"Unknown target format '{target}'")
+    return time.time() - start
+
+
+def collect_inputs(paths, target=None):
+    '''
+    Expand directories into the files in them that can be converted to 'target', in sorted order.
+    Without a target only tomograms (.mrc/.rec) are picked up, so earlier .mha outputs are not converted again.
+    '''
+    extensions = [ext for ext, targets in TARGETS.items() if (target in targets if target else ext != '.mha')]
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                inputs.extend(sorted(entry.path for entry in it
+                                     if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions))
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def plan_conversions(inputs, target=None, output_dir=None, force=False):
+    '''
+    Pair every input with its target and output path. Returns (jobs, skipped), where jobs is a list of
+    (input, output, target) and skipped the inputs left out with the reason why.
+    '''
+    jobs = []
+    skipped = []
+    for input_path in inputs:
+        extension = os.path.splitext(input_path)[1].lower()
+        if extension not in TARGETS:
+            skipped.append((input_path, 'unknown input type'))
+            continue
+        file_target = target if target is not None else TARGETS[extension][0]
+        if file_target not in TARGETS[extension]:
+            skipped.append((input_path, f'cannot convert {extension} to {file_target}'))
+            continue
+        output_path = output_path_for(input_path, file_target, output_dir)
+        if not force and is_up_to_date(input_path, output_path):
+            skipped.append((input_path, 'up to date'))
+            continue
+        jobs.append((input_path, output_path, file_target))
+    return jobs, skipped
+
+
+def convert_all(paths, target=None, output_dir=None, n_workers=None, force=False):
+    '''Convert every input on a process pool. Returns the number of conversions that failed.'''
+    jobs, skipped = plan_conversions(collect_inputs(paths, target), target, output_dir, force)
+    for input_path, reason in skipped:
+        print(f"Skipping {input_path}: {reason}")
+    if not jobs:
+        return 0
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if n_workers is None:
+        n_workers = min(len(jobs), int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count())))
+
+    failures = 0
+    total_bytes = 0
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(convert_one, *job): job for job in jobs}
+        for future in as_completed(futures):
+            input_path, output_path, _ = futures[future]
+            try:
+                elapsed = future.result()
+                size = os.path.getsize(input_path)
+            except Exception as e:
+                print(f"Failed to convert {input_path}: {e}")
+                failures += 1
+                continue
+            total_bytes += size
+            print(f"{input_path} -> {output_path}: {size / 2**20:.0f} MiB in {elapsed:.1f} s "
+                  f"({size / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)")
+    elapsed = time.time() - start
+    print(f"Converted {len(jobs) - failures} of {len(jobs)} files, {total_bytes / 2**20:.0f} MiB in {elapsed:.1f} s "
+          f"({total_bytes / 2**20 / max(elapsed, 1e-9):.1f} MiB/s), {len(skipped)} skipped")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert many tomograms or segmentations between formats at once.')
+    parser.add_argument('paths', nargs='+', help='Files and/or directories (e.g. dataset_10067) to convert.')
+    parser.add_argument('-f', '--format', choices=sorted(OUTPUT_EXTENSIONS), default=None,
+                        help='Target format (default: mha for .mrc/.rec inputs, npy for .mha inputs).')
+    parser.add_argument('-o', '--output-dir', default=None, help='Directory for the outputs (default: next to each input).')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or the number of CPUs).')
+    parser.add_argument('--force', action='store_true', help='Convert even if the output is up to date.')
+    args = parser.parse_args()
+
+    failures = convert_all(args.paths, args.format, args.output_dir, args.workers, args.force)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,140 @@ import mrcfile
 import h5py
 import numpy as np
 import os
+import sys
 
-def convert_mrc_to_hdf5(mrc_filename, hdf5_filename):
-    if not os.path.exists(mrc_filename):
-        print(f"Error: The file {mrc_filename} does not exist.")
-        return
+# default chunk layout: 64^3 float32 chunks are 1 MiB, so a sub-volume read only touches the chunks around it
+DEFAULT_CHUNKS = (64, 64, 64)
+
+def parse_chunks(text):
+    """Parse a chunk shape given as 'Z,Y,X' (e.g. '64,64,64'); 'none' means contiguous storage."""
+    if text is None or text.lower() == 'none':
+        return None
+    return tuple(int(n) for n in text.split(','))
+
+def convert_mrc_to_hdf5(mrc_filename, hdf5_filename, chunks=DEFAULT_CHUNKS, compression=None,
+                        compression_opts=None, dtype=np.float32, slab_depth=None):
+    """
+    Stream an .mrc file into the 'voxel_data' dataset of an HDF5 file.
 
-    # Read the .mrc file
-    with mrcfile.open(mrc_filename, permissive=True) as mrc:
-        # Extract the voxel data
-        voxel_data = mrc.data.astype(np.float32)
+    The tomogram is memory-mapped and copied 'slab_depth' z-planes at a time (by default one chunk row deep), so
+    peak memory is one slab rather than the whole volume. 'chunks' sets the HDF5 chunk shape (None for contiguous),
+    'compression' is any h5py filter ('gzip', 'lzf', ...) and 'dtype' the stored type (float32 by default, as
+    before; None keeps the MRC's own type). The voxel size in Angstrom is stored as the dataset's 'voxel_size'
+    attribute (x, y, z). The file is written under a temporary name and renamed when complete.
+    """
+    if not os.path.exists(mrc_filename):
+        raise FileNotFoundError(f"The file {mrc_filename} does not exist.")
 
-    # Write the data to an HDF5 file
-    with h5py.File(hdf5_filename, 'w') as hdf5_file:
-        hdf5_file.create_dataset('voxel_data', data=voxel_data)
+    temp_filename = f"{hdf5_filename}.tmp"
+    with mrcfile.mmap(mrc_filename, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        out_dtype = np.dtype(dtype) if dtype is not None else data.dtype
+        if chunks is not None:
+            # chunks may not be larger than the dataset
+            chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+        if slab_depth is None:
+            slab_depth = chunks[0] if chunks is not None else 16
+        with h5py.File(temp_filename, 'w') as hdf5_file:
+            dataset = hdf5_file.create_dataset('voxel_data', shape=shape, dtype=out_dtype, chunks=chunks,
+                                               compression=compression, compression_opts=compression_opts)
+            dataset.attrs['voxel_size'] = [float(mrc.voxel_size.x), float(mrc.voxel_size.y), float(mrc.voxel_size.z)]
+            # slabs aligned with the chunk rows, so every chunk is written exactly once
+            for start in range(0, shape[0], slab_depth):
+                stop = min(start + slab_depth, shape[0])
+                dataset[start:stop] = np.asarray(data[start:stop], dtype=out_dtype)
+    os.replace(temp_filename, hdf5_filename)
 
     print(f"Converted {mrc_filename} to {hdf5_filename}")
 
+def bin_volume(volume, factor):
+    """Mean-bin a (z, y, x) array by 'factor' along every axis, dropping the remainder at the far edges."""
+    nz, ny, nx = (n // factor for n in volume.shape)
+    trimmed = volume[:nz * factor, :ny * factor, :nx * factor]
+    return trimmed.reshape(nz, factor, ny, factor, nx, factor).mean(axis=(1, 3, 5), dtype=np.float32)
+
+def convert_mrc_to_pyramid(mrc_filename, hdf5_filename, factors=(2, 4, 8), chunks=DEFAULT_CHUNKS,
+                           compression=None, compression_opts=None, dtype=np.float32):
+    """
+    Stream an .mrc file into an HDF5 multiscale pyramid in a single pass.
+
+    'voxel_data' holds the full-resolution volume exactly as convert_mrc_to_hdf5 writes it, and 'bin<f>' the
+    float32 volume mean-binned by f for each of 'factors' (each level binned from the one before, so the factors
+    must divide each other, e.g. 2, 4, 8). Every dataset is chunked and carries 'voxel_size' and 'bin' attributes;
+    the file's 'levels' attribute lists the dataset names from fine to coarse. Each slab read from the MRC is
+    written to all levels before the next one is read.
+    """
+    if not os.path.exists(mrc_filename):
+        raise FileNotFoundError(f"The file {mrc_filename} does not exist.")
+    factors = sorted(factors)
+    steps = [factors[0]] + [b // a for a, b in zip(factors, factors[1:])]
+    if any(a * step != b for a, step, b in zip(factors, steps[1:], factors[1:])):
+        raise ValueError(f"Each pyramid factor must divide the next one, got {factors}")
+
+    temp_filename = f"{hdf5_filename}.tmp"
+    with mrcfile.mmap(mrc_filename, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        voxel_size = np.array([mrc.voxel_size.x, mrc.voxel_size.y, mrc.voxel_size.z], dtype=np.float64)
+        out_dtype = np.dtype(dtype) if dtype is not None else data.dtype
+        # slabs span whole chunk rows of the full-resolution level and a whole number of coarsest voxels
+        slab_depth = max(chunks[0] if chunks is not None else 16, factors[-1])
+        slab_depth -= slab_depth % factors[-1]
+        with h5py.File(temp_filename, 'w') as hdf5_file:
+            levels = [('voxel_data', 1, shape, out_dtype)]
+            levels += [(f'bin{f}', f, tuple(n // f for n in shape), np.dtype(np.float32)) for f in factors]
+            datasets = []
+            for name, factor, level_shape, level_dtype in levels:
+                level_chunks = None if chunks is None else tuple(max(1, min(c, n)) for c, n in zip(chunks, level_shape))
+                dataset = hdf5_file.create_dataset(name, shape=level_shape, dtype=level_dtype, chunks=level_chunks,
+                                                   compression=compression, compression_opts=compression_opts)
+                dataset.attrs['voxel_size'] = voxel_size * factor
+                dataset.attrs['bin'] = factor
+                datasets.append(dataset)
+            hdf5_file.attrs['levels'] = [name for name, *_ in levels]
+
+            for start in range(0, shape[0], slab_depth):
+                slab = np.asarray(data[start:start + slab_depth])
+                datasets[0][start:start + len(slab)] = slab.astype(out_dtype, copy=False)
+                level = slab
+                for dataset, factor, step in zip(datasets[1:], factors, steps):
+                    level = bin_volume(level, step)
+                    level_start = start // factor
+                    stop = min(level_start + len(level), dataset.shape[0])
+                    if stop > level_start:
+                        dataset[level_start:stop] = level[:stop - level_start]
+    os.replace(temp_filename, hdf5_filename)
+
+    print(f"Converted {mrc_filename} to a {len(factors) + 1} level pyramid in {hdf5_filename}")
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Convert a .mrc file to .hdf5 format.")
     parser.add_argument("mrc_filename", type=str, help="The input .mrc file path.")
     parser.add_argument("hdf5_filename", type=str, help="The output .hdf5 file path.")
+    parser.add_argument("--chunks", type=str, default=','.join(map(str, DEFAULT_CHUNKS)),
+                        help="Chunk shape as Z,Y,X, or 'none' for contiguous storage (default: 64,64,64).")
+    parser.add_argument("--compression", type=str, default=None, choices=['gzip', 'lzf'],
+                        help="HDF5 compression filter (default: none).")
+    parser.add_argument("--compression-level", type=int, default=None, help="gzip level, 0-9.")
+    parser.add_argument("--dtype", type=str, default='float32',
+                        help="Stored data type, e.g. float32, float16, int8, or 'native' to keep the MRC's type.")
+    parser.add_argument("--pyramid", type=str, default=None,
+                        help="Also write mean-binned levels with these factors, e.g. 2,4,8.")
 
     args = parser.parse_args()
 
-    convert_mrc_to_hdf5(args.mrc_filename, args.hdf5_filename)
-
+    dtype = None if args.dtype == 'native' else args.dtype
+    try:
+        if args.pyramid:
+            factors = [int(f) for f in args.pyramid.split(',')]
+            convert_mrc_to_pyramid(args.mrc_filename, args.hdf5_filename, factors, parse_chunks(args.chunks),
+                                   args.compression, args.compression_level, dtype)
+        else:
+            convert_mrc_to_hdf5(args.mrc_filename, args.hdf5_filename, parse_chunks(args.chunks), args.compression,
+                                args.compression_level, dtype)
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -1,8 +1,6 @@
-import mrcfile
-import SimpleITK as sitk
 import os
 import argparse
-import numpy as np
+from stream_export import export_metaimage
 
 def create_directory(directory_path):
     try:
@@ -13,20 +11,13 @@ def create_directory(directory_path):
         print(f"An error occurred: {e}")
 
 def convert_mrc_to_mha(mrc_file_path, output_dir):
-    # Load the .mrc file
-    with mrcfile.open(mrc_file_path, mode='r') as mrc:
-        data = mrc.data
-
-    # Create a MetaImage
-    img = sitk.GetImageFromArray(data)
-
     # Ensure the output directory exists
     create_directory(output_dir)
 
-    # Save the image
+    # Stream the .mrc voxels into a MetaImage, keeping the voxel size and origin
     output_file_name = os.path.splitext(os.path.basename(mrc_file_path))[0] + '.mha'
     output_file_path = os.path.join(output_dir, output_file_name)
-    sitk.WriteImage(img, output_file_path)
+    export_metaimage(mrc_file_path, output_file_path)
     print(f"Converted {mrc_file_path} to {output_file_path}")
 
 def main():
@@ -1,20 +1,11 @@
-import mrcfile
-import nibabel as nib
 import os
 import argparse
-import numpy as np
+from stream_export import export_nifti
 
 def convert_mrc_to_nii(mrc_file_path, output_dir):
-    # Load the .mrc file
-    with mrcfile.open(mrc_file_path, mode='r') as mrc:
-        data = mrc.data
-
-    # Create a NIfTI image
-    img = nib.Nifti1Image(data, affine=np.eye(4))
-
-    # Save the image
+    # Stream the .mrc voxels into a .nii file, keeping the voxel size and origin
     output_file_path = os.path.join(output_dir, os.path.splitext(os.path.basename(mrc_file_path))[0] + '.nii')
-    nib.save(img, output_file_path)
+    export_nifti(mrc_file_path, output_file_path)
 
 def main():
     parser = argparse.ArgumentParser(description='Convert .mrc files to .nii format.')
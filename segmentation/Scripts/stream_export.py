@@ -0,0 +1,118 @@
+'''
+Write an MRC tomogram as NIfTI-1 (.nii) or MetaImage (.mha) without holding it in memory.
+
+Both formats store a small header followed by the raw voxels with x varying fastest, which is exactly the order of
+the (z, y, x) data in an MRC file. So the header is written by hand here and the voxels are streamed straight from
+the memory-mapped MRC a few z-planes at a time, instead of building a nibabel or SimpleITK image (each of which
+copies the whole volume first). Peak memory is one slab.
+
+The MRC voxel size and origin are carried over, in Angstrom (the MRC unit), so segmentations drawn in ITK-SNAP
+line up with the tomogram in physical coordinates. float16 tomograms are written as float32, since neither format
+has a half-precision type that ITK-SNAP reads.
+
+Dependencies: numpy, mrcfile
+'''
+import os
+import struct
+import numpy as np
+import mrcfile
+
+# NIfTI-1 datatype codes and MetaImage element types for the dtypes MRC files can hold
+NIFTI_DATATYPES = {'int8': 256, 'uint8': 2, 'int16': 4, 'uint16': 512, 'float32': 16}
+MET_ELEMENT_TYPES = {'int8': 'MET_CHAR', 'uint8': 'MET_UCHAR', 'int16': 'MET_SHORT', 'uint16': 'MET_USHORT',
+                     'float32': 'MET_FLOAT'}
+# planes per write; bounds memory use independently of the tomogram size
+SLAB_DEPTH = 16
+
+
+def output_dtype(dtype):
+    '''Little-endian dtype the voxels are written as.'''
+    dtype = np.dtype(dtype)
+    if dtype.name not in NIFTI_DATATYPES:
+        dtype = np.dtype(np.float32)
+    return dtype.newbyteorder('<')
+
+
+def mrc_geometry(mrc):
+    '''(voxel size, origin) of an open MRC file as (x, y, z) tuples in Angstrom. A zero voxel size becomes 1.'''
+    voxel_size = tuple(float(v) if v > 0 else 1.0 for v in (mrc.voxel_size.x, mrc.voxel_size.y, mrc.voxel_size.z))
+    origin = tuple(float(v) for v in (mrc.header.origin.x, mrc.header.origin.y, mrc.header.origin.z))
+    return voxel_size, origin
+
+
+def nifti_header(shape, dtype, voxel_size, origin):
+    '''
+    The 352-byte NIfTI-1 single-file header (348-byte header plus an empty extension flag) for a (z, y, x) volume.
+    The sform/qform map voxel indices to physical coordinates with the given spacing and origin.
+    '''
+    nz, ny, nx = shape
+    dtype = output_dtype(dtype)
+    vx, vy, vz = voxel_size
+    ox, oy, oz = origin
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)                                   # sizeof_hdr
+    struct.pack_into('<c', header, 38, b'r')                                 # regular
+    struct.pack_into('<8h', header, 40, 3, nx, ny, nz, 1, 1, 1, 1)           # dim
+    struct.pack_into('<hh', header, 70, NIFTI_DATATYPES[dtype.name], dtype.itemsize * 8)  # datatype, bitpix
+    struct.pack_into('<8f', header, 76, 1.0, vx, vy, vz, 1.0, 1.0, 1.0, 1.0)  # pixdim (qfac 1)
+    struct.pack_into('<f', header, 108, 352.0)                               # vox_offset
+    struct.pack_into('<f', header, 112, 1.0)                                 # scl_slope
+    struct.pack_into('<hh', header, 252, 1, 1)                               # qform_code, sform_code (scanner)
+    struct.pack_into('<6f', header, 256, 0.0, 0.0, 0.0, ox, oy, oz)         # quatern_b/c/d, qoffset_x/y/z
+    struct.pack_into('<4f', header, 280, vx, 0.0, 0.0, ox)                   # srow_x
+    struct.pack_into('<4f', header, 296, 0.0, vy, 0.0, oy)                   # srow_y
+    struct.pack_into('<4f', header, 312, 0.0, 0.0, vz, oz)                   # srow_z
+    header[344:348] = b'n+1\x00'                                             # magic
+    return bytes(header) + b'\x00\x00\x00\x00'
+
+
+def metaimage_header(shape, dtype, voxel_size, origin):
+    '''The text header of a single-file MetaImage (.mha) for a (z, y, x) volume.'''
+    nz, ny, nx = shape
+    dtype = output_dtype(dtype)
+    lines = [
+        'ObjectType = Image',
+        'NDims = 3',
+        'BinaryData = True',
+        'BinaryDataByteOrderMSB = False',
+        'CompressedData = False',
+        'TransformMatrix = 1 0 0 0 1 0 0 0 1',
+        'Offset = {} {} {}'.format(*origin),
+        'CenterOfRotation = 0 0 0',
+        'AnatomicalOrientation = RAI',
+        'ElementSpacing = {} {} {}'.format(*voxel_size),
+        f'DimSize = {nx} {ny} {nz}',
+        f'ElementType = {MET_ELEMENT_TYPES[dtype.name]}',
+        'ElementDataFile = LOCAL',
+    ]
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+def write_voxels(f, data, dtype):
+    '''Stream a (z, y, x) array (typically memory-mapped) to an open file, SLAB_DEPTH planes at a time.'''
+    for start in range(0, data.shape[0], SLAB_DEPTH):
+        slab = np.ascontiguousarray(data[start:start + SLAB_DEPTH], dtype=dtype)
+        f.write(memoryview(slab).cast('B'))
+
+
+def export_mrc(mrc_file_path, output_path, make_header):
+    '''Write 'output_path' as make_header(...) followed by the streamed voxels, renaming it into place when done.'''
+    temp_path = f"{output_path}.tmp"
+    with mrcfile.mmap(mrc_file_path, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        voxel_size, origin = mrc_geometry(mrc)
+        dtype = output_dtype(data.dtype)
+        with open(temp_path, 'wb') as f:
+            f.write(make_header(data.shape, dtype, voxel_size, origin))
+            write_voxels(f, data, dtype)
+    os.replace(temp_path, output_path)
+
+
+def export_nifti(mrc_file_path, output_path):
+    '''Stream an MRC file to an uncompressed .nii file.'''
+    export_mrc(mrc_file_path, output_path, nifti_header)
+
+
+def export_metaimage(mrc_file_path, output_path):
+    '''Stream an MRC file to an uncompressed single-file .mha.'''
+    export_mrc(mrc_file_path, output_path, metaimage_header)
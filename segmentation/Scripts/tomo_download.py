@@ -0,0 +1,182 @@
+'''
+Concurrent, resumable downloads of CryoET Data Portal tomograms into the segmentation layout.
+
+All requested (dataset_id, run_id) pairs are resolved to tomogram URLs and sizes with one metadata query. The
+files are then fetched by a small pool of threads into <store>/dataset_<id>/run_<id>.mrc, the layout described in
+the segmentation README. Each transfer writes to a .part file. An interrupted transfer is resumed with an HTTP
+Range request. A file only gets its final name once its size has been verified.
+A .part file larger than the expected size cannot be resumed, so it is discarded and the transfer restarts.
+A run whose file is already in the store with the right size is not downloaded again.
+
+The resolver is a parameter: anything that maps a list of pairs to {(dataset_id, run_id): (url, size)} works, so
+the downloader can be pointed at a local HTTP server instead of the portal (see static_resolver). A resolver can
+map a pair to an exception instead (e.g. a run that belongs to another dataset), which is reported as a failure.
+
+Progress goes to stderr, so callers can keep stdout for the resulting file paths.
+
+Dependencies: cryoet_data_portal (only for portal_resolver)
+'''
+import os
+import sys
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CHUNK_SIZE = 8 * 2**20
+MAX_ATTEMPTS = 3
+
+
+def portal_resolver(pairs):
+    '''
+    Resolve (dataset_id, run_id) pairs to {(dataset_id, run_id): (https url, size in bytes)} with one query for
+    the runs and one for their tomograms. When a run has several tomograms the portal's default one is used,
+    otherwise the one with the lowest id. A pair whose run belongs to a different dataset maps to a ValueError.
+    '''
+    from cryoet_data_portal import Client, Run, Tomogram
+    client = Client()
+    pairs = [(int(dataset_id), int(run_id)) for dataset_id, run_id in pairs]
+    run_ids = sorted({run_id for _, run_id in pairs})
+    run_datasets = {run.id: run.dataset_id for run in Run.find(client, query_filters=[Run.id._in(run_ids)])}
+    tomograms = Tomogram.find(client, query_filters=[Tomogram.run_id._in(run_ids)])
+    best = dict()
+    for tomogram in tomograms:
+        key = (not tomogram.is_visualization_default, tomogram.id)
+        if tomogram.run_id not in best or key < best[tomogram.run_id][0]:
+            size = int(tomogram.file_size_mrc) if tomogram.file_size_mrc else None
+            best[tomogram.run_id] = (key, tomogram.https_mrc_file, size)
+    resolved = dict()
+    for dataset_id, run_id in pairs:
+        if run_id in run_datasets and run_datasets[run_id] != dataset_id:
+            # the store layout is by dataset, so a mismatched pair would be saved under the wrong dataset
+            resolved[(dataset_id, run_id)] = ValueError(f"run {run_id} belongs to dataset {run_datasets[run_id]}, "
+                                                        f"not {dataset_id}")
+        elif run_id in best:
+            resolved[(dataset_id, run_id)] = best[run_id][1:]
+    return resolved
+
+
+def static_resolver(base_url, sizes=None):
+    '''
+    A resolver for a plain HTTP server laid out like the store (<base_url>/dataset_<id>/run_<id>.mrc), e.g. a local
+    stand-in for the portal. 'sizes' optionally maps pairs to expected sizes.
+    '''
+    def resolve(pairs):
+        return {(int(d), int(r)): (f"{base_url.rstrip('/')}/dataset_{int(d)}/run_{int(r)}.mrc",
+                                   (sizes or dict()).get((int(d), int(r))))
+                for d, r in pairs}
+    return resolve
+
+
+def store_path(store_dir, dataset_id, run_id):
+    return os.path.join(store_dir, f"dataset_{dataset_id}", f"run_{run_id}.mrc")
+
+
+def fetch(url, part_path, expected_size=None):
+    '''
+    Append the rest of 'url' to 'part_path', resuming from its current size with a Range request.
+    Returns the total size the server reported (or None if it did not say).
+    '''
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if expected_size is not None and offset > expected_size:
+        # not a prefix of the file we want (e.g. left over from an older version), start from scratch
+        os.remove(part_path)
+        offset = 0
+    if expected_size is not None and offset == expected_size:
+        return expected_size
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=60)
+    except urllib.error.HTTPError as e:
+        # 416: nothing left past 'offset', the partial file is already complete
+        if e.code == 416 and offset:
+            return offset
+        raise
+    with response:
+        total = None
+        if response.status == 206:
+            content_range = response.headers.get('Content-Range', '')
+            if '/' in content_range and not content_range.endswith('*'):
+                total = int(content_range.rsplit('/', 1)[1])
+            mode = 'ab'
+        else:
+            # the server ignored the range and sent the whole file
+            offset = 0
+            mode = 'wb'
+        if total is None and response.headers.get('Content-Length') is not None:
+            total = offset + int(response.headers['Content-Length'])
+        with open(part_path, mode) as f:
+            for block in iter(lambda: response.read(CHUNK_SIZE), b''):
+                f.write(block)
+    return total
+
+
+def download_file(url, path, expected_size=None):
+    '''
+    Download 'url' to 'path' through 'path.part', resuming and retrying up to MAX_ATTEMPTS times.
+    Returns 'present' if the file was already there, otherwise 'downloaded'.
+    Raises ValueError if the finished file does not have the expected size.
+    '''
+    if os.path.exists(path) and (expected_size is None or os.path.getsize(path) == expected_size):
+        return 'present'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    part_path = f"{path}.part"
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            total = fetch(url, part_path, expected_size)
+            break
+        except (OSError, urllib.error.URLError) as e:
+            # client errors (missing file, bad request) will not go away by retrying
+            client_error = isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500
+            if attempt == MAX_ATTEMPTS or client_error:
+                raise
+            print(f"Retrying {url} after error: {e}", file=sys.stderr)
+            time.sleep(2 ** attempt)
+    size = os.path.getsize(part_path)
+    expected = expected_size if expected_size is not None else total
+    if expected is not None and size != expected:
+        # a short file is left for the next attempt to resume from, an overlong one can never become right
+        if size > expected:
+            os.remove(part_path)
+        raise ValueError(f"{url}: got {size} bytes, expected {expected}")
+    os.replace(part_path, path)
+    return 'downloaded'
+
+
+def download_runs(pairs, store_dir, resolver=portal_resolver, n_workers=4):
+    '''
+    Download the tomogram of every (dataset_id, run_id) pair into 'store_dir' with 'n_workers' concurrent transfers.
+    Returns {pair: path} for the pairs that are now in the store; failures are reported and left out.
+    '''
+    pairs = [(int(dataset_id), int(run_id)) for dataset_id, run_id in pairs]
+    resolved = resolver(pairs)
+    for pair in pairs:
+        if pair not in resolved:
+            print(f"No tomogram found for dataset {pair[0]}, run {pair[1]}", file=sys.stderr)
+    paths = dict()
+    total_bytes = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict()
+        for pair, resolution in resolved.items():
+            if isinstance(resolution, Exception):
+                print(f"Failed to download dataset {pair[0]}, run {pair[1]}: {resolution}", file=sys.stderr)
+                continue
+            url, size = resolution
+            path = store_path(store_dir, *pair)
+            futures[executor.submit(download_file, url, path, size)] = (pair, path)
+        for future in as_completed(futures):
+            pair, path = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f"Failed to download dataset {pair[0]}, run {pair[1]}: {e}", file=sys.stderr)
+                continue
+            if status == 'downloaded':
+                total_bytes += os.path.getsize(path)
+            print(f"{status}: {path}", file=sys.stderr)
+            paths[pair] = path
+    elapsed = time.time() - start
+    print(f"{len(paths)} of {len(pairs)} tomograms in the store, {total_bytes / 2**20:.0f} MiB downloaded in "
+          f"{elapsed:.1f} s", file=sys.stderr)
+    return paths
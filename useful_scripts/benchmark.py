@@ -0,0 +1,223 @@
+'''
+Benchmark suite for the frame-generation pipeline on synthetic data.
+
+A synthetic tomogram (noise plus a bright blob at each motor) of the requested size and dtype is written as a
+.rec file next to a matching FM*.mod model (see imod_model.write_slicer_angles). Each stage of the pipeline is
+then timed on its own, followed by the whole create_training_images.py sequence for that pair:
+- labels:    read_slicer_angles on the .mod file
+- rotation:  rotated_slab_averages of every motor (voxels/s counts the resampled slab voxels)
+- normalize: robust_normalize_image on 256x256 frames
+- positives: get_frames_from_slab (crop + normalize + flip)
+- negatives: get_negative_frames_from_slab (tiling + exclusion mask + batch normalize)
+- png:       PNG encoding of the frames
+- end_to_end: process_pair from create_training_images.py with an empty slab cache, plus writing the PNGs
+With --max-memory, rotation and the end-to-end run use that working-memory budget, so a budget below what the
+tomogram's slabs need times the out-of-core (block by block) path. Every stage runs 'repeats' times and the fastest run is reported. Results can be saved as JSON and compared to a
+saved baseline; stages more than --tolerance slower than the baseline are flagged. Everything runs offline, in
+one process, on the CPU.
+
+Usage:
+python benchmark.py [--shape 200,960,960] [--dtype float32] [--motors 1] [--repeats 3] [--save results.json]
+                    [--baseline baseline.json] [--max-memory GB]
+
+Dependencies: numpy, scipy, mrcfile, PIL
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import mrcfile
+from imod_model import read_slicer_angles, write_slicer_angles
+from slab_projection import rotated_slab_averages, DEFAULT_MAX_BYTES
+from normalization import robust_normalize_image
+from frame_writer import FrameBuffer, FrameWriter, encode_png
+from create_fm_images import get_frames_from_slab
+from create_negative_images import get_negative_frames_from_slab
+from create_training_images import process_pair
+
+THICKNESS = 15
+FRAME_SIZE = 256
+
+
+def synthetic_labels(shape, n_motors, rng):
+    '''Random slicer angles, with centers far enough from the edges for a full positive crop.'''
+    nz, ny, nx = shape
+    margin = np.array([nx, ny, nz]) // 4
+    centers = rng.uniform(margin, np.array([nx, ny, nz]) - margin, size=(n_motors, 3))
+    angles = rng.uniform(-60, 60, size=(n_motors, 3))
+    return np.round(np.hstack([angles, centers]), 2)
+
+
+def synthetic_volume(shape, dtype, labels, rng):
+    '''Gaussian noise with a bright 20-voxel blob at every label center, in the requested dtype.'''
+    volume = rng.standard_normal(shape, dtype=np.float32)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    for x_center, y_center, z_center in labels[:, 3:6]:
+        blob = (x - x_center) ** 2 + (y - y_center) ** 2 + (z - z_center) ** 2 < 10 ** 2
+        volume[blob] += 4
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        volume = np.clip(volume * (info.max / 8), info.min, info.max)
+    return volume.astype(dtype)
+
+
+def make_fixture(workdir, shape=(200, 960, 960), dtype='float32', n_motors=1, seed=0):
+    '''Write a synthetic tomogram and model into 'workdir'. Returns (mod_file, rec_file, labels).'''
+    rng = np.random.default_rng(seed)
+    labels = synthetic_labels(shape, n_motors, rng)
+    run_dir = os.path.join(workdir, 'synthetic', 'run1')
+    os.makedirs(run_dir, exist_ok=True)
+    mod_file = os.path.join(run_dir, 'FMsynthetic.mod')
+    rec_file = os.path.join(run_dir, 'synthetic.rec')
+    write_slicer_angles(mod_file, labels)
+    with mrcfile.new(rec_file, overwrite=True) as mrc:
+        mrc.set_data(synthetic_volume(shape, dtype, labels, rng))
+    return mod_file, rec_file, labels
+
+
+def best_time(function, repeats):
+    '''Fastest wall time of 'repeats' calls, and the last result.'''
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmarks(workdir, shape=(200, 960, 960), dtype='float32', n_motors=1, repeats=3, max_bytes=DEFAULT_MAX_BYTES):
+    '''Time every stage on a fresh fixture in 'workdir'. Returns {stage: {'seconds', 'rate', 'unit'}}.'''
+    mod_file, rec_file, labels = make_fixture(workdir, shape, dtype, n_motors)
+    results = dict()
+
+    def record(stage, seconds, amount, unit):
+        results[stage] = {'seconds': seconds, 'rate': amount / seconds if seconds > 0 else float('inf'), 'unit': unit}
+
+    seconds, _ = best_time(lambda: read_slicer_angles(mod_file), repeats)
+    record('labels', seconds, len(labels), 'labels/s')
+
+    with mrcfile.mmap(rec_file, mode='r', permissive=True) as mrc:
+        seconds, slabs = best_time(lambda: rotated_slab_averages(mrc.data, labels, THICKNESS, max_bytes=max_bytes),
+                                   repeats)
+    record('rotation', seconds, n_motors * THICKNESS * shape[1] * shape[2], 'voxels/s')
+
+    frames = [slabs[0][i:i + FRAME_SIZE, i:i + FRAME_SIZE] for i in range(0, 64, 4)]
+    frames = [frame for frame in frames if frame.shape == (FRAME_SIZE, FRAME_SIZE)]
+    seconds, _ = best_time(lambda: [robust_normalize_image(frame) for frame in frames], repeats)
+    record('normalize', seconds, len(frames), 'frames/s')
+
+    seconds, buffer = best_time(lambda: run_into_buffer(get_frames_from_slab, slabs, 5, FRAME_SIZE), repeats)
+    record('positives', seconds, len(buffer.records), 'frames/s')
+    positives = buffer.records
+
+    seconds, buffer = best_time(lambda: run_negatives(slabs, labels), repeats)
+    record('negatives', seconds, len(buffer.records), 'frames/s')
+
+    encode_frames = [record_[0] for record_ in positives + buffer.records]
+    seconds, _ = best_time(lambda: [encode_png(frame) for frame in encode_frames], repeats)
+    record('png', seconds, len(encode_frames), 'frames/s')
+
+    def end_to_end():
+        # a fresh cache and output directory every time, so nothing is reused between repeats
+        cache_dir = tempfile.mkdtemp(dir=workdir)
+        datadir = tempfile.mkdtemp(dir=workdir)
+        try:
+            status, records, spans = process_pair(mod_file, rec_file, 'synthetic', 0, cache_dir, 5, 1.0, FRAME_SIZE,
+                                                  max_bytes)
+            if status != 'done':
+                raise RuntimeError(f"process_pair returned '{status}' for the synthetic tomogram of shape {shape}")
+            with FrameWriter(datadir, backend='png') as writer:
+                writer.extend(records)
+            return len(records)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            shutil.rmtree(datadir, ignore_errors=True)
+    seconds, n_frames = best_time(end_to_end, repeats)
+    record('end_to_end', seconds, int(np.prod(shape)), 'voxels/s')
+    results['end_to_end']['frames_per_s'] = n_frames / seconds if seconds > 0 else float('inf')
+    return results
+
+
+def run_into_buffer(function, slabs, *args):
+    buffer = FrameBuffer()
+    for k, slab in enumerate(slabs):
+        function(slab, *args, buffer, f'synthetic_{k}')
+    return buffer
+
+
+def run_negatives(slabs, labels):
+    buffer = FrameBuffer()
+    for k, slab in enumerate(slabs):
+        get_negative_frames_from_slab(slab, labels, FRAME_SIZE, buffer, f'synthetic_{k}', motor=k, thickness=THICKNESS)
+    return buffer
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    '''Print each stage's time against the baseline. Returns the stages more than 'tolerance' slower.'''
+    regressions = []
+    print(f"{'stage':<12}{'baseline s':>12}{'now s':>12}{'change':>10}")
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]['seconds']
+        change = result['seconds'] / before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > tolerance:
+            regressions.append(stage)
+            flag = '  slower'
+        print(f"{stage:<12}{before:>12.4f}{result['seconds']:>12.4f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the frame-generation pipeline on synthetic tomograms.')
+    parser.add_argument('--shape', default='200,960,960', help='Tomogram shape as Z,Y,X (default: 200,960,960).')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8', 'int16', 'uint16'],
+                        help='Voxel type of the synthetic tomogram (default: float32).')
+    parser.add_argument('-m', '--motors', type=int, default=1, help='Number of motors in the tomogram (default: 1).')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Runs per stage; the fastest counts (default: 3).')
+    parser.add_argument('--save', default=None, help='Save the results as JSON (e.g. to use as a baseline later).')
+    parser.add_argument('--baseline', default=None, help='Compare against results saved earlier with --save.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_BYTES / 2**30,
+                        help=f'Working-memory budget for the slabs in GiB (default: {DEFAULT_MAX_BYTES / 2**30:g}).')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Flag stages this much slower than the baseline (default: 0.1 = 10%%).')
+    args = parser.parse_args()
+    shape = tuple(int(n) for n in args.shape.split(','))
+    if len(shape) != 3 or min(shape[1:]) < 2 * FRAME_SIZE:
+        # get_frames_from_slab crops up to size pixels past the slab center
+        parser.error(f'--shape must be Z,Y,X with Y and X of at least {2 * FRAME_SIZE}')
+
+    workdir = tempfile.mkdtemp(prefix='frame_benchmark_')
+    try:
+        results = run_benchmarks(workdir, shape, args.dtype, args.motors, args.repeats, int(args.max_memory * 2**30))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"shape {shape}, {args.dtype}, {args.motors} motor(s), {args.max_memory:g} GiB budget, best of {args.repeats}")
+    for stage, result in results.items():
+        print(f"{stage:<12}{result['seconds']:>10.4f} s{result['rate']:>16.4g} {result['unit']}")
+    print(f"end to end: {results['end_to_end']['frames_per_s']:.1f} frames/s")
+    results = {'config': {'shape': shape, 'dtype': args.dtype, 'motors': args.motors, 'max_memory': args.max_memory},
+               **results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != json.loads(json.dumps(results['config'])):
+            print(f"Warning: the baseline was run with {baseline.get('config')}")
+        stages = {stage: result for stage, result in results.items() if stage != 'config'}
+        regressions = compare_to_baseline(stages, baseline, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
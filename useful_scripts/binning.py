@@ -0,0 +1,179 @@
+'''
+On-load binning of tomograms to a common pixel size, before slab extraction.
+
+The tomograms in the tree come at mixed pixel sizes, so a fixed 256-pixel crop covers a different physical area
+in each of them. binned_tomogram reads the voxel size from the MRC header and bins the tomogram by the integer
+factor that brings it closest to the target pixel size (never below the original). Everything downstream works
+on the binned volume, so rotation, averaging, tiling and normalization handle f^3 fewer voxels. The label
+centers are moved into binned pixel coordinates to match. Two methods:
+- 'mean':    every f x f x f block of voxels is averaged (fast, slight blurring).
+- 'fourier': Fourier cropping, keeping only the frequencies the binned grid can hold (sharper, no aliasing).
+             It is done one axis at a time (x and y per group of z planes, then z per group of rows), which for a
+             box-shaped crop is the same as cropping the 3D transform.
+Both read the volume through a memory map a group of planes at a time, and no group goes over 'max_bytes'. The
+far edges are trimmed to a multiple of the factor. The binned volume is written as a float32 MRC with the binned
+voxel size into a size-bounded cache ('binned' under the slab cache directory, see slab_cache.py). Every script
+and later run then reuses it, and slabs cut from it are cached under its own identity.
+
+Usage:
+python binning.py <input.rec> <output.mrc> --pixel-size 20 [--method mean|fourier]
+
+Dependencies: numpy, mrcfile
+'''
+import os
+import time
+import hashlib
+import numpy as np
+import mrcfile
+from slab_cache import get_cache
+from slab_projection import DEFAULT_MAX_BYTES
+from tracing import traced
+
+METHODS = ('mean', 'fourier')
+# bump when the binning changes so stale binned volumes are no longer used
+BIN_VERSION = 1
+
+
+def binning_factor(voxel_size, target_pixel_size):
+    '''
+    Integer factor that brings 'voxel_size' closest to 'target_pixel_size' (both in Å). 1 if there is no target,
+    the header has no voxel size (0), or the tomogram is already at or above the target pixel size.
+    '''
+    if not target_pixel_size or voxel_size <= 0:
+        return 1
+    return max(1, int(round(target_pixel_size / voxel_size)))
+
+
+def binned_labels(labels, factor, method='mean'):
+    '''
+    Label rows with their centers moved into the pixel coordinates of the binned volume (angles are unchanged).
+    A mean-binned voxel i covers original voxels i*f ... i*f + f - 1, so its center is at i*f + (f - 1) / 2; a
+    Fourier-cropped sample i sits at original position i*f.
+    '''
+    labels = np.array(np.reshape(labels, (-1, 6)), dtype=np.float64)
+    offset = (factor - 1) / 2 if method == 'mean' else 0.0
+    labels[:, 3:6] = (labels[:, 3:6] - offset) / factor
+    return labels
+
+
+def fourier_crop(array, n, axis):
+    '''Keep the lowest frequencies of 'array' along 'axis' so it has 'n' samples, preserving the mean (float32).'''
+    spectrum = np.fft.rfft(array, axis=axis)
+    spectrum = np.take(spectrum, np.arange(n // 2 + 1), axis=axis)
+    return (np.fft.irfft(spectrum, n=n, axis=axis) * (n / array.shape[axis])).astype(np.float32)
+
+
+def bin_mean(volume, out, factor, max_bytes):
+    '''Mean-bin 'volume' into 'out' (shape = volume shape // factor), a group of z planes at a time.'''
+    nz, ny, nx = out.shape
+    # input plus its float32 mean, per output plane
+    per_plane = factor ** 3 * ny * nx * (volume.dtype.itemsize + 4)
+    group = max(1, max_bytes // per_plane)
+    for z in range(0, nz, group):
+        stop = min(z + group, nz)
+        block = np.asarray(volume[z * factor:stop * factor, :ny * factor, :nx * factor])
+        out[z:stop] = block.reshape(stop - z, factor, ny, factor, nx, factor).mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def bin_fourier(volume, out, factor, max_bytes, scratch_path):
+    '''
+    Fourier-crop 'volume' into 'out': x and y a group of z planes at a time, then z a group of rows at a time.
+    The intermediate (all z planes, binned in x and y) is kept in memory if it fits in half of 'max_bytes',
+    otherwise in a scratch .npy file at 'scratch_path'.
+    '''
+    nz, ny, nx = out.shape
+    shape = (nz * factor, ny, nx)
+    if np.prod(shape) * 4 <= max_bytes // 2:
+        xy = np.empty(shape, dtype=np.float32)
+    else:
+        xy = np.lib.format.open_memmap(scratch_path, mode='w+', dtype=np.float32, shape=shape)
+    try:
+        # input, float64 copy and complex spectrum of one input plane
+        per_plane = factor ** 2 * ny * nx * (volume.dtype.itemsize + 8 + 16)
+        group = max(1, max_bytes // per_plane)
+        for z in range(0, shape[0], group):
+            block = np.asarray(volume[z:min(z + group, shape[0]), :ny * factor, :nx * factor], dtype=np.float64)
+            xy[z:z + group] = fourier_crop(fourier_crop(block, nx, axis=2), ny, axis=1)
+        per_row = shape[0] * nx * (4 + 8 + 16)
+        group = max(1, max_bytes // per_row)
+        for y in range(0, ny, group):
+            out[:, y:y + group] = fourier_crop(np.asarray(xy[:, y:y + group], dtype=np.float64), nz, axis=0)
+    finally:
+        if isinstance(xy, np.memmap):
+            del xy
+            os.remove(scratch_path)
+
+
+def bin_to_mrc(rec_file, out_file, factor, method='mean', max_bytes=DEFAULT_MAX_BYTES):
+    '''Write 'rec_file' binned by 'factor' to 'out_file' as a float32 MRC with the binned voxel size.'''
+    if method not in METHODS:
+        raise ValueError(f"Unknown binning method '{method}', expected one of {METHODS}.")
+    with mrcfile.mmap(rec_file, mode='r', permissive=True) as mrc:
+        volume = mrc.data
+        voxel_size = mrc.voxel_size
+        shape = tuple(n // factor for n in volume.shape)
+        if min(shape) == 0:
+            raise ValueError(f"{rec_file} with shape {volume.shape} is too small to bin by {factor}")
+        with mrcfile.new_mmap(out_file, shape=shape, mrc_mode=2, overwrite=True) as out:
+            if method == 'mean':
+                bin_mean(volume, out.data, factor, max_bytes)
+            else:
+                bin_fourier(volume, out.data, factor, max_bytes, f"{out_file}.scratch.npy")
+            out.voxel_size = (voxel_size.x * factor, voxel_size.y * factor, voxel_size.z * factor)
+            out.update_header_stats()
+
+
+def bin_key(rec_file, factor, method):
+    '''Hash of everything that determines the binned volume.'''
+    stat = os.stat(rec_file)
+    parts = [BIN_VERSION, os.path.realpath(rec_file), stat.st_size, stat.st_mtime_ns, int(factor), method]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def binned_tomogram(rec_file, labels, target_pixel_size, method='mean', cache_dir=None, max_bytes=DEFAULT_MAX_BYTES,
+                    tracer=None):
+    '''
+    Bring one tomogram to 'target_pixel_size' (Å).
+
+    Returns (path of the volume to extract slabs from, labels in that volume's pixel coordinates, factor). With a
+    factor of 1 the original file and labels come back unchanged. Binned volumes are cached under
+    '<cache_dir>/binned'; without a cache directory they are written next to the tomogram.
+    '''
+    with mrcfile.open(rec_file, header_only=True, permissive=True) as mrc:
+        voxel_size = float(mrc.voxel_size.x)
+    factor = binning_factor(voxel_size, target_pixel_size)
+    if factor == 1:
+        return rec_file, np.reshape(labels, (-1, 6)), 1
+    with traced(tracer, 'binning', factor=factor, method=method) as span:
+        if cache_dir is None:
+            path = f"{os.path.splitext(rec_file)[0]}_bin{factor}_{method}.mrc"
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(rec_file):
+                bin_to_mrc(rec_file, path, factor, method, max_bytes)
+                span.update(bytes_read=os.path.getsize(rec_file), bytes_written=os.path.getsize(path))
+        else:
+            cache = get_cache(os.path.join(cache_dir, 'binned'))
+            key = bin_key(rec_file, factor, method)
+            path = cache.get_path(key)
+            span['hit'] = path is not None
+            if path is None:
+                temp_path = cache.temp_path(key)
+                bin_to_mrc(rec_file, temp_path, factor, method, max_bytes)
+                span.update(bytes_read=os.path.getsize(rec_file), bytes_written=os.path.getsize(temp_path))
+                cache.put_file(key, temp_path)
+                path = cache.path(key)
+    return path, binned_labels(labels, factor, method), factor
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Bin a tomogram to a target pixel size.')
+    parser.add_argument('input', help='Input .rec/.mrc file.')
+    parser.add_argument('output', help='Output .mrc file (float32).')
+    parser.add_argument('--pixel-size', type=float, required=True, help='Target pixel size in Å.')
+    parser.add_argument('--method', choices=METHODS, default='mean', help='Binning method (default: mean).')
+    args = parser.parse_args()
+    with mrcfile.open(args.input, header_only=True, permissive=True) as mrc:
+        factor = binning_factor(float(mrc.voxel_size.x), args.pixel_size)
+    start = time.time()
+    bin_to_mrc(args.input, args.output, factor, args.method)
+    print(f"Binned {args.input} by {factor} ({args.method}) in {time.time() - start:.1f} s")
@@ -1,31 +1,49 @@
-import subprocess
 import numpy as np
 import mrcfile
-from PIL import Image
 import os
-import glob
 import time
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from slab_projection import rotated_slab_averages, DEFAULT_MAX_BYTES
+from tomo_catalog import build_catalog
+from discovery import scan_tree, find_files
+from slab_cache import get_cache, slab_key
+from imod_model import read_slicer_angles
+from normalization import robust_normalize_image
+from frame_writer import FrameWriter, FrameBuffer, BACKENDS
+from tracing import Tracer, TraceLog, traced, read_spans, summarize, write_chrome_trace
+from binning import binned_tomogram, METHODS
 
 """
 This script is designed for processing and analyzing tomography data, specifically targeting flagellar motors in biological samples. It utilizes a series of image processing and analysis techniques to extract, normalize, rotate, and generate frame images from volumetric data. The script automates the extraction of angles from .mod files, normalizes and rotates volumes based on these angles, and slices the rotated volumes into 2D frame images.
 
 Dependencies:
-- subprocess: For executing shell commands within Python.
 - numpy: Used for numerical operations, especially array manipulations.
 - mrcfile: For reading and writing MRC files, which are commonly used in electron microscopy and tomography.
-- PIL (Python Imaging Library): For image processing tasks, such as saving arrays as images.
-- os, glob: For navigating the file system and searching for files matching specific patterns.
+- PIL (Python Imaging Library), via frame_writer: For saving arrays as images, or packing them into npz/hdf5/tar shards with an index.
+- os, discovery: For navigating the file system and searching for files matching specific patterns.
+- imod_model: Reads slicer angles straight from binary IMOD .mod files, so IMOD does not need to be loaded.
+- slab_projection (scipy): In-process rotation and averaging of the slab around each motor, replacing IMOD rotatevol.
+- binning: Optional binning of every tomogram to a common target pixel size (mean or Fourier cropping, using the header voxel size) before its slabs are extracted, so crops cover the same physical area.
+- tracing: Per-tomogram spans (labels, cache, read, rotation, averaging, tiling, normalization, encoding, write) written as JSON lines, with a summary report at the end of the run.
 
 Main Functions:
-- mod_to_csv(modfile, output_path): Extracts rotation angles from .mod files and saves them to a CSV file.
-- robust_normalize_image(image): Normalizes image intensities to enhance contrast while avoiding outliers.
-- new_rotate_vol(input_file, labels, thickness, output_path, temp_dir): Rotates volumetric data based on specified angles and extracts averaged 2D frames.
-- get_frames(rotated_vol, num_frames, size, datadir): Generates and saves frame images from the rotated volume, with options for random cropping.
-- find_files(root_dir): Searches a directory tree for .mod and .rec files, returning their paths along with the names of their parent directories.
-- main(): Orchestrates the workflow by calling the functions defined above with appropriate arguments based on the file system structure and desired processing parameters.
+- mod_to_labels(modfile): Extracts rotation angles and centers from .mod files as an (n, 6) array.
+- robust_normalize_image(image): Normalizes image intensities to enhance contrast while avoiding outliers (shared with create_negative_images.py, see normalization.py).
+- new_rotate_vol(input_file, labels, thickness, output_path, temp_dir): Rotates volumetric data based on specified angles and extracts averaged 2D frames. Only the slab around each motor is resampled, in memory; temp_dir is no longer written to. With several motors, one slab per motor is written (see slab_paths). With a slab cache, slabs already computed by any script are reused.
+- averaged_slabs(input_file, labels, thickness, cache, max_bytes): Returns the averaged rotated slab of each label, in memory, computing all of them from one read of the volume. Tomograms too large for the memory budget are processed out of core, block by block, so no tomogram is skipped for its size any more.
+- slab_paths(output_path, n_slabs): The file each motor's slab is written to.
+- get_frames_from_slab(img, num_frames, size, writer, name, source): Crops frames from a slab already in memory.
+- get_frames(rotated_vol, num_frames, size, writer, source): Generates frame images from the rotated volume, with options for random cropping, and adds them to a FrameWriter (or FrameBuffer).
+- find_files(root_dir, index_path, listing): Searches a directory tree for .mod and .rec files in a single scandir pass, returning their paths along with the names of their parent directories (see discovery.py).
+- process_pair(mod_file, rec_file, dir_name, i, temp_dir, cache_dir): Runs the whole workflow for one mod/rec pair inside its own scratch directory and returns its frames and trace spans.
+- run_pairs(process, extra_args, ...): Process pool driver with the resumable manifest and the trace log, shared with create_training_images.py.
+- main(n_workers, backend, chrome_trace, max_memory_gb, pixel_size, bin_method): Orchestrates the workflow by spreading the mod/rec pairs over a pool of worker processes. Finished pairs are recorded in a manifest so a rerun (e.g. after a job timeout) skips completed work. Every run writes a trace (with the reason for every skipped tomogram) and prints its summary; see tracing.py.
 
 Usage:
-This script is intended to be run as a standalone program. Adjust the
+This script is intended to be run as a standalone program (python create_fm_images.py [-j WORKERS] [-b BACKEND] [--chrome-trace FILE] [--max-memory GB] [--pixel-size A] [--bin-method mean|fourier]). Adjust the
 `main_dir`, `temp_dir`, and `datadir` variables to match your file system
 layout before execution. The script processes all files with pattern: "FM*.mod"
 as well as the corresponding .rec files found within the `main_dir` directory, applying the described image processing and analysis techniques.
@@ -34,123 +52,280 @@ Author: Braxton Owens
 Date: Feb 28 2024
 """
 
-def mod_to_csv(modfile, output_path):
+def mod_to_labels(modfile):
     try:
-        bash_command = f"imodinfo -a {modfile} | grep '^slicerAngle' | awk '{{print $(NF-5),$(NF-4),$(NF-3),$(NF-2),$(NF-1),$NF}}' > {output_path}"
-        subprocess.run(bash_command, shell=True, check=True)
-        return True
-    except subprocess.CalledProcessError:
-        print(f"Failed to convert {modfile} to CSV.")
-        return False
-
-def robust_normalize_image(image):
-    p01, p99 = np.percentile(image, [1, 99])
-    clipped_image = np.clip(image, p01, p99)
-    normalized_image = ((clipped_image - p01) / (p99 - p01)) * 255
-    return normalized_image.astype(np.uint8)
-
-def new_rotate_vol(input_file, labels, thickness, output_path, temp_dir):
-    my_labels = np.loadtxt(labels, delimiter=' ')
-    if my_labels.ndim == 1:
-        my_labels = np.reshape(my_labels, (1, -1))
-    for i, label in enumerate(my_labels):
-        with mrcfile.open(input_file) as mrc:
-            z, height, width = mrc.data.shape
-            if height > 1000:
-                return True
-        x_center, y_center, z_center = label[3:]
-        x_rot, y_rot, z_rot = label[:3]
-        temp_output_file = os.path.join(temp_dir, f"{os.path.basename(input_file)[:-4]}_tomo_{i}.rec")
-        cmd = f"rotatevol {input_file} {temp_output_file} -size {width},{height},{thickness} -center {x_center},{y_center},{z_center} -angles {z_rot},{y_rot},{x_rot} -v 0"
-        subprocess.run(cmd, shell=True)
-        with mrcfile.open(temp_output_file) as mrc:
-            my_data = mrc.data
-        averaged_img = np.average(my_data.astype('float32'), axis=0)
-        with mrcfile.new(output_path, overwrite=True) as final_mrc:
-            final_mrc.set_data(averaged_img.astype(np.float32))
-        os.remove(temp_output_file)
-
-def get_frames(rotated_vol, num_frames, size, datadir):
-    with mrcfile.open(rotated_vol) as mrc:
-        img = mrc.data
+        return read_slicer_angles(modfile)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read labels from {modfile}: {e}")
+        return None
+
+def averaged_slabs(input_file, labels, thickness, cache=None, tracer=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Averaged rotated slab for each label row. All slabs missing from the cache are computed together from a single
+    read of the volume, or block by block if that would need more than max_bytes of memory (see slab_projection.py).
+    """
+    my_labels = np.reshape(labels, (-1, 6))
+    slabs = [None] * len(my_labels)
+    keys = [None] * len(my_labels)
+    if cache is not None:
+        with traced(tracer, 'cache') as span:
+            for k, label in enumerate(my_labels):
+                keys[k] = slab_key(input_file, label, thickness)
+                slabs[k] = cache.get(keys[k])
+            hits = [slab for slab in slabs if slab is not None]
+            span.update(hits=len(hits), misses=len(slabs) - len(hits), bytes_read=sum(slab.nbytes for slab in hits))
+    missing = [k for k, slab in enumerate(slabs) if slab is None]
+    if missing:
+        with mrcfile.mmap(input_file, mode='r', permissive=True) as mrc:
+            # resample and average only the slabs we need instead of running rotatevol once per motor
+            computed = rotated_slab_averages(mrc.data, my_labels[missing], thickness, tracer=tracer,
+                                             max_bytes=max_bytes)
+        with traced(tracer, 'cache') as span:
+            for k, slab in zip(missing, computed):
+                slabs[k] = slab
+                if cache is not None:
+                    cache.put(keys[k], slab)
+                    span['bytes_written'] = span.get('bytes_written', 0) + slab.nbytes
+    return slabs
+
+def slab_paths(output_path, n_slabs):
+    """Where new_rotate_vol writes each slab: output_path itself for one motor, '<name>_motor<k>.arec' for several."""
+    if n_slabs == 1:
+        return [output_path]
+    root, ext = os.path.splitext(output_path)
+    return [f"{root}_motor{k}{ext}" for k in range(n_slabs)]
+
+def new_rotate_vol(input_file, labels, thickness, output_path, temp_dir, cache=None, tracer=None,
+                   max_bytes=DEFAULT_MAX_BYTES):
+    slabs = averaged_slabs(input_file, labels, thickness, cache, tracer, max_bytes)
+    # one file per motor, so a tomogram with several motors no longer keeps only the last slab
+    with traced(tracer, 'write', slabs=len(slabs)) as span:
+        for averaged_img, path in zip(slabs, slab_paths(output_path, len(slabs))):
+            with mrcfile.new(path, overwrite=True) as final_mrc:
+                final_mrc.set_data(averaged_img.astype(np.float32))
+            span['bytes_written'] = span.get('bytes_written', 0) + os.path.getsize(path)
+
+def crop_stops(extent, size, margin=50):
+    """
+    Range [low, high) for the end of a size-pixel crop along an axis of 'extent' pixels, so that the crop keeps
+    the slab's middle at least 'margin' pixels inside it where it can and never runs past the slab's edges.
+    """
+    high = min(extent // 2 + size, extent + 1)
+    low = max(min(extent // 2 + margin, high - 1), size)
+    return low, high
+
+def get_frames_from_slab(img, num_frames, size, writer, name, source='', tracer=None):
+    """Crop num_frames random motor-centered frames from an averaged slab already in memory."""
     height, width = img.shape
-    if size > width:
+    if size > width or size > height:
         print("size is greater than image")
+        if tracer is not None:
+            tracer.skip('tiling', 'size is greater than image')
         return
     
-    for i in range(num_frames):
-        x_max = np.random.randint((width // 2) + 50, width // 2 + size)
-        y_max = np.random.randint((height // 2) + 50, height // 2 + size)
-        frame = img[x_max-size:x_max, y_max-size:y_max]
-        n_frame = robust_normalize_image(frame)
-        n_frame = np.flipud(n_frame)
-        im = Image.fromarray(n_frame)
-        splittxt = os.path.splitext(os.path.basename(rotated_vol))[0]
-        frame_path = f"{datadir}/{splittxt}_frame{i}.png"
-        im.save(frame_path)
-
-
-def find_files(root_dir):
-    mod_files = []
-    rec_files = []
-    dir_names = []
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for i,mod_file in enumerate(glob.glob(os.path.join(dirpath, 'FM*.mod'))):
-            rec_file_list = glob.glob(os.path.join(dirpath, '*.rec'))
-            for j,rec_file in enumerate(rec_file_list):
-                mod_files.append(mod_file)
-                rec_files.append(rec_file)
-                path_parts = dirpath.strip(os.path.sep).split(os.path.sep)
-                if len(path_parts) >= 2:
-                    last_two_dirs = f'{path_parts[-2]}_{path_parts[-1]}'
-                else:
-                    last_two_dirs = dirpath
-                dir_names.append(f'{last_two_dirs}_{i}_{j}')
-    return mod_files, rec_files, dir_names
-
-def is_csv_empty(file_path):
+    with traced(tracer, 'tiling', frames=num_frames):
+        crops = []
+        # crop windows are clamped to the slab, so small (e.g. binned) slabs still give full size x size frames
+        row_stops = crop_stops(height, size)
+        col_stops = crop_stops(width, size)
+        for i in range(num_frames):
+            x_max = np.random.randint(*row_stops)
+            y_max = np.random.randint(*col_stops)
+            crops.append((img[x_max-size:x_max, y_max-size:y_max], x_max-size, y_max-size))
+    with traced(tracer, 'normalization', frames=num_frames):
+        n_frames = [np.flipud(robust_normalize_image(frame)) for frame, _, _ in crops]
+    for i, (n_frame, (_, row, col)) in enumerate(zip(n_frames, crops)):
+        writer.add(n_frame, f"{name}_frame{i}", source=source, row=row, col=col, label=1)
+
+def get_frames(rotated_vol, num_frames, size, writer, source='', tracer=None):
+    with traced(tracer, 'read') as span:
+        with mrcfile.open(rotated_vol) as mrc:
+            img = mrc.data
+        span['bytes_read'] = img.nbytes
+    splittxt = os.path.splitext(os.path.basename(rotated_vol))[0]
+    get_frames_from_slab(img, num_frames, size, writer, splittxt, source, tracer)
+
+
+def trace_labels(mod_file, tracer):
+    """mod_to_labels inside a 'labels' span, recording a skip if the model has no usable labels."""
+    with tracer.span('labels', mod_file=mod_file) as span:
+        labels = mod_to_labels(mod_file)
+        if labels is not None:
+            span.update(labels=len(labels), bytes_read=os.path.getsize(mod_file))
+    if labels is None:
+        tracer.skip('labels', 'unreadable model')
+    elif len(labels) == 0:
+        tracer.skip('labels', 'no slicer angles in model')
+    return labels
+
+def load_manifest(manifest_path):
+    """
+    Return the set of (mod_file, rec_file) pairs already recorded as finished in the manifest.
+    Pairs recorded as 'too_large' by older versions of the scripts are not counted, so they are processed now.
+    """
+    finished = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) >= 2 and parts[2:3] != ['too_large']:
+                    finished.add((parts[0], parts[1]))
+    return finished
+
+def process_pair(mod_file, rec_file, dir_name, i, temp_dir, cache_dir, max_bytes=DEFAULT_MAX_BYTES, pixel_size=None,
+                 bin_method='mean'):
+    """
+    Run the full mod -> label -> rotated slab -> frames sequence for one mod/rec pair.
+    Each call works in its own scratch directory inside temp_dir, so pairs can run side by side.
+    With a target pixel_size (Å), the tomogram is binned to it first (see binning.py).
+    Returns a status ('done' or 'skipped' (no usable labels)), the frame records,
+    which the parent process writes out, and the trace spans of this pair.
+    """
+    # forked workers inherit the parent's random state; reseed so workers don't crop identical frames
+    np.random.seed()
+    scratch_dir = tempfile.mkdtemp(prefix=f"{dir_name}_", dir=temp_dir)
+    # the slabs go in the scratch directory too, so they are removed with it and never collide between workers
+    output_path = os.path.join(scratch_dir, f"{dir_name}_averaged_{i}.arec")
+    frames = FrameBuffer()
+    tracer = Tracer(rec_file)
     try:
-        return os.path.getsize(file_path) == 0
-    except OSError:
-        return True
-
-# def check_frames_exist(splittxt, datadir):
-#     """Check if any frame images for a given volume already exist in datadir."""
-#     frame_filename = f"{datadir}/{splittxt}_frame{0}.png"
-#     print(f"{datadir}/{splittxt}_frame{0}.png")
-#     if os.path.exists(frame_filename):
-#         return True 
-#     return False
-
-def main():
+        labels = trace_labels(mod_file, tracer)
+        if labels is None or len(labels) == 0:
+            return 'skipped', frames.records, tracer.spans
+        volume_file, labels, factor = binned_tomogram(rec_file, labels, pixel_size, bin_method, cache_dir, max_bytes,
+                                                      tracer)
+        new_rotate_vol(volume_file, labels, 15, output_path, scratch_dir, get_cache(cache_dir), tracer, max_bytes)
+        for path in slab_paths(output_path, len(labels)):
+            get_frames(path, 5, 256, frames, source=rec_file, tracer=tracer)
+        return 'done', frames.records, tracer.spans
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def run_pairs(process, extra_args, mod_files, rec_files, dir_names, catalog, datadir, backend,
+              manifest_path, trace_log, n_workers):
+    """
+    Run process(mod_file, rec_file, dir_name, i, *extra_args) for every pair on a process pool.
+    Pairs whose tomogram is missing from the catalog, or that are already in the manifest, are skipped.
+    process returns (status, frame records, trace spans); the parent writes all frames through one FrameWriter,
+    records each pair in the manifest once its frames are safely on disk, and writes every span (including the
+    reason for each skipped pair) to 'trace_log', a tracing.TraceLog.
+    """
+    finished = load_manifest(manifest_path)
+    # the parent's own spans: skips decided here, and encoding/writing the frames of each pair
+    tracer = Tracer()
+    # manifest lines for pairs whose frames may still be sitting in an unwritten shard
+    unflushed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor, open(manifest_path, 'a') as manifest, \
+            FrameWriter(datadir, backend=backend) as writer:
+        futures = dict()
+        for i, mod_file in enumerate(mod_files):
+            tracer.tomogram = rec_files[i]
+            entry = catalog.get(rec_files[i])
+            if entry is None:
+                tracer.skip('discovery', 'no readable header in the catalog')
+            elif (mod_file, rec_files[i]) in finished:
+                tracer.skip('discovery', 'finished in an earlier run')
+            else:
+                future = executor.submit(process, mod_file, rec_files[i], dir_names[i], i, *extra_args)
+                futures[future] = i
+        trace_log.write(tracer.drain())
+        # only the parent writes frames, the manifest and the trace, so output from different workers never interleaves
+        for future in as_completed(futures):
+            i = futures[future]
+            tracer.tomogram = rec_files[i]
+            try:
+                status, records, spans = future.result()
+            except Exception as e:
+                print(f"Failed to process {mod_files[i]} with {rec_files[i]}: {e}")
+                tracer.skip('failed', f"{type(e).__name__}: {e}")
+                trace_log.write(tracer.drain())
+                continue
+            trace_log.write(spans)
+            line = f"{mod_files[i]}\t{rec_files[i]}\t{status}\n"
+            if not records:
+                manifest.write(line)
+                manifest.flush()
+                continue
+            shards_before = writer.shard_number
+            writer.extend(records)
+            writer.record_spans(tracer)
+            trace_log.write(tracer.drain())
+            if backend == 'png':
+                # the PNGs are on disk once extend returns, so the pair is finished as soon as its index rows are
+                writer.flush()
+                manifest.write(line)
+                manifest.flush()
+                continue
+            # a pair only counts as finished once a completed shard holds its frames
+            if writer.shard_number != shards_before:
+                manifest.writelines(unflushed)
+                manifest.flush()
+                unflushed = []
+            unflushed.append(line)
+        tracer.tomogram = ''
+        writer.flush()
+        writer.record_spans(tracer)
+        trace_log.write(tracer.drain())
+        manifest.writelines(unflushed)
+
+def trace_discovery(main_dir, index_path, catalog_path, trace_log):
+    """Scan the tree, read the tomogram headers and pair the files inside one 'discovery' span."""
+    tracer = Tracer()
+    with tracer.span('discovery', root=main_dir) as span:
+        # read only the MRC headers up front; tomograms whose header cannot be read are left out of the catalog
+        listing = scan_tree(main_dir, index_path)
+        catalog = build_catalog(main_dir, catalog_path, listing=listing)
+        mod_files, rec_files, dir_names = find_files(main_dir, listing=listing)
+        span.update(tomograms=len(catalog), pairs=len(mod_files))
+    trace_log.write(tracer.spans)
+    return catalog, mod_files, rec_files, dir_names
+
+def finish_trace(trace_path, chrome_trace=None):
+    """Print the summary report of a run's trace and optionally convert it to a Chrome trace."""
+    spans = read_spans(trace_path)
+    print(summarize(spans))
+    print(f"Trace written to {trace_path}")
+    if chrome_trace:
+        write_chrome_trace(spans, chrome_trace)
+
+def main(n_workers=None, backend='png', chrome_trace=None, max_memory_gb=DEFAULT_MAX_BYTES / 2**30, pixel_size=None,
+         bin_method='mean'):
     main_dir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/compute/TomoDB1_d2/FlagellarMotor_P2'
     temp_dir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/temp_dir'
     datadir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/all_imgs'
-    skipped_dirs_log_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/skipped_dirs.txt'
-
-    mod_files, rec_files, dir_names = find_files(main_dir)
-    for i, mod_file in enumerate(mod_files):
-        output_path = os.path.join(temp_dir, f"{dir_names[i]}_averaged_{i}.arec")
-        
-        # splittxt = os.path.splitext(os.path.basename(output_path))[0]
-        # if check_frames_exist(splittxt, datadir):
-        #     #print(f"Skipping {mod_file} as frames already exist in {datadir}")
-        #     continue
-        if not mod_to_csv(mod_file, "label.csv") or is_csv_empty("label.csv"):
-            with open(skipped_dirs_log_path, 'a') as log_file:
-                log_file.write(f"{dir_names[i]}\n") 
-            continue  
-        rotate_vol_time = time.time()
-        val = new_rotate_vol(rec_files[i], "label.csv", 15, output_path, temp_dir)
-        print(f'time to rotate vol: {rotate_vol_time - time.time()}')
-        if val:
-            continue
-        subprocess.run('rm label.csv', shell=True, check=False)
-        get_frames_time = time.time()
-        get_frames(output_path, 5, 256, datadir)
-        print(f'time to get frames: {get_frames_time - time.time()}')
+    catalog_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/tomo_catalog.csv'
+    # one JSON-lines trace per run, with the skip reasons that used to go to skipped_dirs.txt
+    trace_path = f"/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/traces/create_fm_images_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    # directory listings, revalidated by mtime so reruns don't re-list the whole tree
+    index_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/dir_index.json'
+    # averaged slabs shared with create_negative_images.py and later runs
+    cache_dir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/slab_cache'
+    # pairs that finished (or were skipped) in earlier runs are listed here and not redone
+    manifest_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/finished_pairs.tsv'
+    if n_workers is None:
+        n_workers = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
 
-if __name__ == "__main__":
-    main()
- 
+    with TraceLog(trace_path) as trace_log:
+        catalog, mod_files, rec_files, dir_names = trace_discovery(main_dir, index_path, catalog_path, trace_log)
+        run_pairs(process_pair, (temp_dir, cache_dir, int(max_memory_gb * 2**30), pixel_size, bin_method),
+                  mod_files, rec_files, dir_names, catalog, datadir, backend, manifest_path, trace_log, n_workers)
+    finish_trace(trace_path, chrome_trace)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create flagellar motor frame images from all mod/rec pairs.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or the number of CPUs).')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='png',
+                        help="How frames are stored: one PNG per frame (default) or 'npz', 'hdf5' or 'tar' shards.")
+    parser.add_argument('--chrome-trace', default=None,
+                        help='Also write the run\'s trace in Chrome trace format (chrome://tracing, Perfetto) to this file.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_BYTES / 2**30,
+                        help='Working memory per worker for the slabs of one tomogram, in GiB; larger tomograms are '
+                             f'processed out of core in blocks (default: {DEFAULT_MAX_BYTES / 2**30:g}).')
+    parser.add_argument('--pixel-size', type=float, default=None,
+                        help='Bin every tomogram by the integer factor closest to this pixel size in Å before '
+                             'extracting slabs (default: no binning).')
+    parser.add_argument('--bin-method', choices=METHODS, default='mean',
+                        help="How to bin: block 'mean' (default) or 'fourier' cropping.")
+    args = parser.parse_args()
+    main(args.workers, args.backend, args.chrome_trace, args.max_memory, args.pixel_size, args.bin_method)
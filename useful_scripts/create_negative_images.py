@@ -1,153 +1,123 @@
-import subprocess
 import numpy as np
 import mrcfile
 import os
-import glob
-from PIL import Image
 import time
-import csv
+import argparse
+from slab_projection import centers_in_slab, DEFAULT_MAX_BYTES
+from slab_cache import get_cache
+from tiling import exclusion_mask, extract_tiles
+from frame_writer import FrameWriter, BACKENDS
+from tracing import Tracer, TraceLog, traced
+from binning import binned_tomogram, METHODS
+from create_fm_images import new_rotate_vol, slab_paths, trace_labels, trace_discovery, finish_trace
 
-# the following functions are taken from Braxton's create_fm_images.py
-def mod_to_csv(modfile, output_path):
-    bash_command = f"imodinfo -a {modfile} | grep '^slicerAngle' | awk '{{print $(NF-5),$(NF-4),$(NF-3),$(NF-2),$(NF-1),$NF}}' > {output_path}"
-    subprocess.run(bash_command, shell=True, check=True)
+# half the side of the square kept clear around every motor, in pixels
+EXCLUSION_HALF_WIDTH = 30
 
-def robust_normalize_image(image):
-    p01, p99 = np.percentile(image, [1, 99])
-    clipped_image = np.clip(image, p01, p99)
-    normalized_image = ((clipped_image - p01) / (p99 - p01)) * 255
-    return normalized_image.astype(np.uint8)
-
-def new_rotate_vol(input_file, labels, thickness, output_path, temp_dir):
-    my_labels = np.loadtxt(labels, delimiter=' ')
-    if my_labels.ndim == 1:
-        my_labels = np.reshape(my_labels, (1, -1))
-    for i, label in enumerate(my_labels):
-        with mrcfile.open(input_file) as mrc:
-            z, height, width = mrc.data.shape
-            if height > 1000:
-                return True
-        x_center, y_center, z_center = label[3:]
-        x_rot, y_rot, z_rot = label[:3]
-        temp_output_file = os.path.join(temp_dir, f"{os.path.basename(input_file)[:-4]}_tomo_{i}.rec")
-        cmd = f"rotatevol {input_file} {temp_output_file} -size {width},{height},{thickness} -center {x_center},{y_center},{z_center} -angles {z_rot},{y_rot},{x_rot}"
-        subprocess.run(cmd, shell=True)
-        with mrcfile.open(temp_output_file) as mrc:
-            my_data = mrc.data
-        averaged_img = np.average(my_data.astype('float32'), axis=0)
-        with mrcfile.new(output_path, overwrite=True) as final_mrc:
-            final_mrc.set_data(averaged_img.astype(np.float32))
-        os.remove(temp_output_file)
-
-def find_files(root_dir):
-    mod_files = []
-    rec_files = []
-    dir_names = []
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for i,mod_file in enumerate(glob.glob(os.path.join(dirpath, 'FM*.mod'))):
-            rec_file_list = glob.glob(os.path.join(dirpath, '*.rec'))
-            for j,rec_file in enumerate(rec_file_list):
-                mod_files.append(mod_file)
-                rec_files.append(rec_file)
-                path_parts = dirpath.strip(os.path.sep).split(os.path.sep)
-                if len(path_parts) >= 2:
-                    last_two_dirs = f'{path_parts[-2]}_{path_parts[-1]}'
-                else:
-                    last_two_dirs = dirpath
-                dir_names.append(f'{last_two_dirs}_{i}_{j}')
-    return mod_files, rec_files, dir_names
-
-def is_csv_empty(file_path):
-    try:
-        return os.path.getsize(file_path) == 0
-    except OSError:
-        return True
-    
-def get_csv_length(file_path):
-    with open(file_path, 'r') as f:
-        reader = csv.reader(f)
-        data = list(reader)
-        return len(data)
-
-
-def get_negative_frames(rotated_vol, labels, size, datadir):
-    # open rec file
-    with mrcfile.open(rotated_vol) as mrc:
-        img = mrc.data
+def get_negative_frames_from_slab(img, labels, size, writer, name, source='', max_frames=None, motor=0, thickness=15,
+                                  tracer=None):
+    """
+    Tile an averaged slab already in memory into negative frames, skipping the region around every motor it shows.
+    The slab is the one rotated about label row 'motor'; other motors are projected into its frame and excluded
+    too when they lie within the slab's thickness. If max_frames is given, a random subset of at most that many
+    of the kept tiles is emitted.
+    """
     height, width = img.shape
-    # load motor labels
-    all_labels = np.loadtxt(labels, delimiter=' ')
-    if get_csv_length(labels) > 1:
-        print("This script is currently only designed to work on tomograms with only one motor present. More than one gets tricky, sorry.")
-        return
+    # motor labels, one (n, 6) row per motor
+    all_labels = np.reshape(labels, (-1, 6))
 
     # determine the number of splits in the x and y directions
     y_split = height // size
     x_split = width // size
+    n_rows, n_cols = max(y_split - 1, 0), max(x_split - 1, 0) # n-1 to stay inside the bounds of the image
 
-    # horizontal strips = np.array_split(img, y_split, axis=0)
-    # tiled_img = list()
-    # for i in range(y_split):
-    #     vertical_strips = np.array_split(horizontal_strips[i], x_split, axis=1)
-    #     for j in range(x_split):
-    #         tiled_img.append(vertical_strips[j])
-    # not sure how to keep track of motor location using np.array_split. This way may be faster though, come back to later maybe
+    with traced(tracer, 'tiling', step='exclusion mask'):
+        # check if any motor is present in the slice
+        if len(all_labels) == 0:
+            # tile the whole image
+            mask = np.ones((n_rows, n_cols), dtype=bool)
+        else:
+            # define an exclusion box around each visible motor and drop the tiles that touch any of them
+            centers = centers_in_slab(all_labels, motor, thickness, height, width)
+            visible = np.abs(centers[:, 2] - thickness // 2) <= thickness / 2 + EXCLUSION_HALF_WIDTH
+            mask = exclusion_mask(n_rows, n_cols, size, centers[visible][:, [1, 0]], EXCLUSION_HALF_WIDTH)
+        if max_frames is not None and mask.sum() > max_frames:
+            # keep a random subset of the allowed tiles, before any of them are normalized
+            keep = np.random.choice(np.flatnonzero(mask), size=max_frames, replace=False)
+            mask = np.zeros_like(mask)
+            mask.flat[keep] = True
 
+    # slice, normalize and flip all kept tiles in one batch, then hand each frame to the writer
+    frames, positions = extract_tiles(img, size, mask, n_rows, n_cols, tracer=tracer)
+    for n_frame, (i, j) in zip(frames, positions):
+        writer.add(n_frame, f"{name}_frame{i}_{j}", source=source, row=i*size, col=j*size, label=0)
 
-    # check if a motor is present in the slice
-    if is_csv_empty(labels):
-        # tile the image and save each frame as a .png file
-        for i in range(y_split-1): # n-1 to stay inside the bounds of the image
-            for j in range(x_split-1):
-                frame = img[i*size:(i+1)*size, j*size:(j+1)*size]
-                n_frame = robust_normalize_image(frame)
-                n_frame = np.flipud(n_frame)
-                im = Image.fromarray(n_frame)
-                splittxt = os.path.splitext(os.path.basename(rotated_vol))[0]
-                frame_path = f"{datadir}/{splittxt}_frame{i}_{j}.png"
-                im.save(frame_path)
-    else:
-        # define an exclusion box around motor
-        motor_xycoords = (all_labels[4],all_labels[5])
-        exclusion_box_start = (motor_xycoords[0] - 30, motor_xycoords[1] - 30)
-        exclusion_box_end = (motor_xycoords[0] + 30, motor_xycoords[1] + 30)
-        # split the image into frames and save each frame as a .png file, skipping the exclusion box
-        for i in range(y_split-1):
-            for j in range(x_split-1):
-                if (i*size < exclusion_box_start[0] or i*size > exclusion_box_end[0]) and (j*size < exclusion_box_start[1] or j*size > exclusion_box_end[1]):
-                    frame = img[i*size:(i+1)*size, j*size:(j+1)*size]
-                    n_frame = robust_normalize_image(frame)
-                    n_frame = np.flipud(n_frame)
-                    im = Image.fromarray(n_frame)
-                    splittxt = os.path.splitext(os.path.basename(rotated_vol))[0]
-                    frame_path = f"{datadir}/{splittxt}_frame{i}_{j}.png"
-                    im.save(frame_path)
+def get_negative_frames(rotated_vol, labels, size, writer, source='', motor=0, tracer=None):
+    # open rec file
+    with traced(tracer, 'read') as span:
+        with mrcfile.open(rotated_vol) as mrc:
+            img = mrc.data
+        span['bytes_read'] = img.nbytes
+    splittxt = os.path.splitext(os.path.basename(rotated_vol))[0]
+    get_negative_frames_from_slab(img, labels, size, writer, splittxt, source, motor=motor, tracer=tracer)
     
 
-def main():
+def main(backend='png', chrome_trace=None, max_memory_gb=DEFAULT_MAX_BYTES / 2**30, pixel_size=None, bin_method='mean'):
     main_dir = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/compute/TomoDB1_d2/FlagellarMotor_P2'
     temp_dir = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/temp_dir'
     datadir = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/all_neg_imgs'
-    skipped_dirs_log_path = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/skipped_dirs.txt'
+    # one JSON-lines trace per run, with the skip reasons that used to go to skipped_dirs.txt
+    trace_path = f"/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/traces/create_negative_images_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    catalog_path = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/tomo_catalog.csv'
+    # directory listings, revalidated by mtime so reruns don't re-list the whole tree
+    index_path = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/eben/dir_index.json'
+    # averaged slabs shared with create_fm_images.py and later runs
+    cache_dir = '/home/ejl62/fsl_groups/grp_tomo_db1_d2/slab_cache'
 
-    mod_files, rec_files, dir_names = find_files(main_dir)
-    for i, mod_file in enumerate(mod_files):
-        output_path = os.path.join(temp_dir, f"{dir_names[i]}_averaged_{i}.arec")
+    with TraceLog(trace_path) as trace_log, FrameWriter(datadir, backend=backend) as writer:
+        catalog, mod_files, rec_files, dir_names = trace_discovery(main_dir, index_path, catalog_path, trace_log)
+        tracer = Tracer()
+        for i, mod_file in enumerate(mod_files):
+            tracer.tomogram = rec_files[i]
+            entry = catalog.get(rec_files[i])
+            if entry is None:
+                tracer.skip('discovery', 'no readable header in the catalog')
+                trace_log.write(tracer.drain())
+                continue
+            output_path = os.path.join(temp_dir, f"{dir_names[i]}_averaged_{i}.arec")
     
-        if not mod_to_csv(mod_file, "label.csv") or is_csv_empty("label.csv"):
-            with open(skipped_dirs_log_path, 'a') as log_file:
-                log_file.write(f"{dir_names[i]}\n") 
-            continue  
-        rotate_vol_time = time.time()
-        val = new_rotate_vol(rec_files[i], "label.csv", 15, output_path, temp_dir)
-        print(f'time to rotate vol: {rotate_vol_time - time.time()}')
-        if val:
-            continue
-        subprocess.run('rm label.csv', shell=True, check=False)
-        get_frames_time = time.time()
-        get_negative_frames(output_path, "label.csv", 256, datadir)
-        print(f'time to get frames: {get_frames_time - time.time()}')
-        subprocess.run('rm label.csv', shell=True, check=False)
+            labels = trace_labels(mod_file, tracer)
+            if labels is None or len(labels) == 0:
+                trace_log.write(tracer.drain())
+                continue  
+            # with a target pixel size, the slabs and the motor positions are those of the binned tomogram
+            volume_file, labels, factor = binned_tomogram(rec_files[i], labels, pixel_size, bin_method, cache_dir,
+                                                          int(max_memory_gb * 2**30), tracer)
+            new_rotate_vol(volume_file, labels, 15, output_path, temp_dir, get_cache(cache_dir), tracer,
+                           int(max_memory_gb * 2**30))
+            for k, path in enumerate(slab_paths(output_path, len(labels))):
+                get_negative_frames(path, labels, 256, writer, source=rec_files[i], motor=k, tracer=tracer)
+            writer.record_spans(tracer)
+            trace_log.write(tracer.drain())
+        tracer.tomogram = ''
+        writer.flush()
+        writer.record_spans(tracer)
+        trace_log.write(tracer.drain())
+    finish_trace(trace_path, chrome_trace)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Create negative (background) frame images from all mod/rec pairs.')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='png',
+                        help="How frames are stored: one PNG per frame (default) or 'npz', 'hdf5' or 'tar' shards.")
+    parser.add_argument('--chrome-trace', default=None,
+                        help='Also write the run\'s trace in Chrome trace format (chrome://tracing, Perfetto) to this file.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_BYTES / 2**30,
+                        help='Working memory for the slabs of one tomogram, in GiB; larger tomograms are processed '
+                             f'out of core in blocks (default: {DEFAULT_MAX_BYTES / 2**30:g}).')
+    parser.add_argument('--pixel-size', type=float, default=None,
+                        help='Bin every tomogram by the integer factor closest to this pixel size in Å before '
+                             'extracting slabs (default: no binning).')
+    parser.add_argument('--bin-method', choices=METHODS, default='mean',
+                        help="How to bin: block 'mean' (default) or 'fourier' cropping.")
+    args = parser.parse_args()
+    main(args.backend, args.chrome_trace, args.max_memory, args.pixel_size, args.bin_method)
\ No newline at end of file
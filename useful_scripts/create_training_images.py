@@ -0,0 +1,102 @@
+'''
+Build a balanced training set of positive (motor-centered) and negative (background) frames in one pass.
+
+Running create_fm_images.py and then create_negative_images.py repeats discovery, label parsing, rotation and slab
+loading for the same tomograms. This script loads each averaged slab once and emits both the labeled positive
+crops and the exclusion-masked negative tiles from it, with a configurable number of negatives per positive.
+Frames go through a single FrameWriter, and the index labels them 1 (motor) or 0 (background). Each run writes a
+JSON-lines trace of every tomogram's stages and skips and prints its summary (see tracing.py).
+
+Usage:
+python create_training_images.py [-j WORKERS] [-b BACKEND] [-n POSITIVES] [-r NEGATIVE_RATIO] [--chrome-trace FILE]
+                                 [--max-memory GB] [--pixel-size A] [--bin-method mean|fourier]
+Adjust the paths in main() to match your file system layout before execution.
+
+Dependencies: numpy, scipy, mrcfile, PIL (see create_fm_images.py and create_negative_images.py)
+'''
+import os
+import time
+import argparse
+import numpy as np
+from slab_cache import get_cache
+from slab_projection import DEFAULT_MAX_BYTES
+from frame_writer import FrameBuffer, BACKENDS
+from tracing import Tracer, TraceLog
+from binning import binned_tomogram, METHODS
+from create_fm_images import averaged_slabs, get_frames_from_slab, run_pairs, trace_labels, trace_discovery, \
+    finish_trace
+from create_negative_images import get_negative_frames_from_slab
+
+
+def process_pair(mod_file, rec_file, dir_name, i, cache_dir, num_positive, negative_ratio, size,
+                 max_bytes=DEFAULT_MAX_BYTES, pixel_size=None, bin_method='mean'):
+    """
+    Emit positive and negative frames for one mod/rec pair from a single load of each averaged slab.
+    Returns a status ('done' or 'skipped'), the frame records for the parent to write and the
+    trace spans of this pair.
+    """
+    # forked workers inherit the parent's random state; reseed so workers don't crop identical frames
+    np.random.seed()
+    frames = FrameBuffer()
+    tracer = Tracer(rec_file)
+    labels = trace_labels(mod_file, tracer)
+    if labels is None or len(labels) == 0:
+        return 'skipped', frames.records, tracer.spans
+    # with a target pixel size, slabs, crops and tiles all come from the binned tomogram
+    volume_file, labels, factor = binned_tomogram(rec_file, labels, pixel_size, bin_method, cache_dir, max_bytes, tracer)
+    slabs = averaged_slabs(volume_file, labels, 15, get_cache(cache_dir), tracer, max_bytes)
+    max_negatives = int(round(negative_ratio * num_positive))
+    for k, slab in enumerate(slabs):
+        name = f"{dir_name}_averaged_{i}" if len(slabs) == 1 else f"{dir_name}_averaged_{i}_motor{k}"
+        get_frames_from_slab(slab, num_positive, size, frames, name, source=rec_file, tracer=tracer)
+        if max_negatives > 0:
+            get_negative_frames_from_slab(slab, labels, size, frames, name, source=rec_file,
+                                          max_frames=max_negatives, motor=k, tracer=tracer)
+    return 'done', frames.records, tracer.spans
+
+
+def main(n_workers=None, backend='png', num_positive=5, negative_ratio=1.0, size=256, chrome_trace=None,
+         max_memory_gb=DEFAULT_MAX_BYTES / 2**30, pixel_size=None, bin_method='mean'):
+    main_dir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/compute/TomoDB1_d2/FlagellarMotor_P2'
+    datadir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/training_imgs'
+    trace_path = f"/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/traces/create_training_images_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    catalog_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/tomo_catalog.csv'
+    index_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/dir_index.json'
+    cache_dir = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/slab_cache'
+    manifest_path = '/home/cbo27/fsl_groups/grp_tomo_db1_d2/braxton/finished_training_pairs.tsv'
+    if n_workers is None:
+        n_workers = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
+
+    with TraceLog(trace_path) as trace_log:
+        catalog, mod_files, rec_files, dir_names = trace_discovery(main_dir, index_path, catalog_path, trace_log)
+        run_pairs(process_pair, (cache_dir, num_positive, negative_ratio, size, int(max_memory_gb * 2**30), pixel_size,
+                                 bin_method),
+                  mod_files, rec_files, dir_names, catalog, datadir, backend,
+                  manifest_path, trace_log, n_workers)
+    finish_trace(trace_path, chrome_trace)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create positive and negative training frames in one pass.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: $SLURM_CPUS_PER_TASK or the number of CPUs).')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='png',
+                        help="How frames are stored: one PNG per frame (default) or 'npz', 'hdf5' or 'tar' shards.")
+    parser.add_argument('-n', '--positives', type=int, default=5,
+                        help='Number of positive (motor) frames per slab (default: 5).')
+    parser.add_argument('-r', '--negative-ratio', type=float, default=1.0,
+                        help='Negative frames per positive frame, at most all allowed tiles (default: 1.0).')
+    parser.add_argument('-s', '--size', type=int, default=256, help='Frame size in pixels (default: 256).')
+    parser.add_argument('--chrome-trace', default=None,
+                        help='Also write the run\'s trace in Chrome trace format (chrome://tracing, Perfetto) to this file.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_BYTES / 2**30,
+                        help='Working memory per worker for the slabs of one tomogram, in GiB; larger tomograms are '
+                             f'processed out of core in blocks (default: {DEFAULT_MAX_BYTES / 2**30:g}).')
+    parser.add_argument('--pixel-size', type=float, default=None,
+                        help='Bin every tomogram by the integer factor closest to this pixel size in Å before '
+                             'extracting slabs (default: no binning).')
+    parser.add_argument('--bin-method', choices=METHODS, default='mean',
+                        help="How to bin: block 'mean' (default) or 'fourier' cropping.")
+    args = parser.parse_args()
+    main(args.workers, args.backend, args.positives, args.negative_ratio, args.size, args.chrome_trace,
+         args.max_memory, args.pixel_size, args.bin_method)
@@ -0,0 +1,111 @@
+'''
+Single-pass discovery of the mod/rec pairs the image scripts work on.
+
+find_files used to be copied into both image scripts; it walked the tree with os.walk and re-ran glob('*.rec') in
+the same directory once per FM*.mod file. Here every directory is listed exactly once with os.scandir, the model
+and tomogram files are grouped in memory, and the result is a typed work list. Optionally the listing of every
+directory is saved to a JSON index. On later runs a directory whose mtime has not changed is taken from the index
+without being listed again (adding, removing or renaming an entry always changes the directory's mtime), so a
+rerun over the shared file system costs one stat per directory.
+
+Dependencies: none
+'''
+import os
+import json
+import fnmatch
+from typing import NamedTuple
+
+
+class WorkItem(NamedTuple):
+    '''One mod/rec pair to process, with the name used for its outputs.'''
+    mod_file: str
+    rec_file: str
+    dir_name: str
+
+
+def list_directory(dirpath):
+    '''List one directory with a single scandir: returns (mtime_ns, file names, subdirectory names).'''
+    files = []
+    subdirs = []
+    mtime = os.stat(dirpath).st_mtime_ns
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    return mtime, sorted(files), sorted(subdirs)
+
+
+def scan_tree(root_dir, index_path=None):
+    '''
+    List every directory under 'root_dir' once. Returns {dirpath: {'mtime', 'files', 'subdirs'}}.
+    If 'index_path' is given, unchanged directories are reused from it and the updated index is saved back.
+    '''
+    previous = dict()
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            previous = json.load(f)
+    listing = dict()
+    stack = [root_dir]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            cached = previous.get(dirpath)
+            if cached is not None and os.stat(dirpath).st_mtime_ns == cached['mtime']:
+                entry = cached
+            else:
+                mtime, files, subdirs = list_directory(dirpath)
+                entry = {'mtime': mtime, 'files': files, 'subdirs': subdirs}
+        except OSError as e:
+            print(f"Failed to list {dirpath}: {e}")
+            continue
+        listing[dirpath] = entry
+        stack.extend(os.path.join(dirpath, name) for name in reversed(entry['subdirs']))
+    if index_path is not None:
+        temp_path = f'{index_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(listing, f)
+        os.replace(temp_path, index_path)
+    return listing
+
+
+def output_name(dirpath):
+    '''The "<parent>_<dir>" prefix the image scripts have always used to name a directory's outputs.'''
+    path_parts = dirpath.strip(os.path.sep).split(os.path.sep)
+    if len(path_parts) >= 2:
+        return f'{path_parts[-2]}_{path_parts[-1]}'
+    return dirpath
+
+
+def find_work_items(root_dir, index_path=None, mod_pattern='FM*.mod', rec_pattern='*.rec', listing=None):
+    '''
+    Pair every model file with every tomogram in the same directory, in a stable (sorted) order.
+    Pass 'listing' (from scan_tree) to reuse a scan that was already done.
+    '''
+    items = []
+    if listing is None:
+        listing = scan_tree(root_dir, index_path)
+    for dirpath in sorted(listing):
+        files = listing[dirpath]['files']
+        mod_files = fnmatch.filter(files, mod_pattern)
+        if not mod_files:
+            continue
+        rec_file_list = fnmatch.filter(files, rec_pattern)
+        last_two_dirs = output_name(dirpath)
+        for i, mod_file in enumerate(mod_files):
+            for j, rec_file in enumerate(rec_file_list):
+                items.append(WorkItem(os.path.join(dirpath, mod_file), os.path.join(dirpath, rec_file),
+                                      f'{last_two_dirs}_{i}_{j}'))
+    return items
+
+
+def find_files(root_dir, index_path=None, listing=None):
+    '''Drop-in for the old find_files: returns parallel lists of mod files, rec files and output names.'''
+    items = find_work_items(root_dir, index_path, listing=listing)
+    mod_files = [item.mod_file for item in items]
+    rec_files = [item.rec_file for item in items]
+    dir_names = [item.dir_name for item in items]
+    return mod_files, rec_files, dir_names
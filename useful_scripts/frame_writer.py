@@ -0,0 +1,212 @@
+'''
+Output backends for the frames produced by create_fm_images.py and create_negative_images.py.
+
+Writing every 256x256 frame as its own PNG leaves hundreds of thousands of tiny files in one directory, which is
+slow to write, list and load on the group's parallel file system. FrameWriter instead packs frames into shards
+and keeps an index.csv next to them with one row per frame: the frame name, the shard file and position in it,
+the source tomogram, the tile coordinates and the label. Backends:
+- 'png':  one PNG per frame, the old layout (the index is still written).
+- 'npz':  shard_XXXXX.npz with a (n, size, size) uint8 'frames' array.
+- 'hdf5': shard_XXXXX.h5 with a (n, size, size) uint8 'frames' dataset (requires h5py).
+- 'tar':  shard_XXXXX.tar of PNG members, readable with tar or WebDataset-style loaders.
+Shards are written to a temporary name and renamed when complete, and their index rows are appended only after
+that, so an interrupted run never leaves index rows pointing at partial shards. A rerun appends new shards after
+the existing ones.
+
+iter_frames(datadir) reads any of these layouts back shard by shard, so training-time reads are sequential bulk
+I/O as well.
+
+The writer keeps a running total of the time spent encoding frames (PNG, or stacking them into a shard array) and
+writing them, and of the bytes written; record_spans hands those to a tracing.Tracer as 'encoding' and 'write'
+spans and starts the totals over.
+
+Dependencies: numpy, PIL, h5py (optional, for the 'hdf5' backend)
+'''
+import os
+import io
+import csv
+import glob
+import time
+import tarfile
+import numpy as np
+from PIL import Image
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+BACKENDS = ('png', 'npz', 'hdf5', 'tar')
+SHARD_EXTENSIONS = {'npz': '.npz', 'hdf5': '.h5', 'tar': '.tar'}
+INDEX_FIELDS = ['name', 'shard', 'position', 'source', 'row', 'col', 'label']
+
+
+def encode_png(frame):
+    '''PNG file contents of one uint8 frame.'''
+    payload = io.BytesIO()
+    Image.fromarray(frame).save(payload, format='PNG')
+    return payload.getvalue()
+
+
+class FrameBuffer:
+    '''
+    Collects frames in memory with the same add() interface as FrameWriter. Worker processes fill one of these
+    and hand its records back to the parent, which writes them all through a single FrameWriter.
+    '''
+    def __init__(self):
+        self.records = []
+
+    def add(self, frame, name, source='', row=0, col=0, label=''):
+        self.records.append((np.ascontiguousarray(frame), name, source, row, col, label))
+
+
+class FrameWriter:
+    '''
+    Write uint8 frames to 'datadir' with the chosen backend, 'shard_size' frames per shard.
+    Use as a context manager, or call close() to flush the last shard.
+    '''
+    def __init__(self, datadir, backend='png', shard_size=4096):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}.")
+        if backend == 'hdf5' and h5py is None:
+            raise ImportError("The 'hdf5' backend needs h5py. Please install it using\npip install h5py")
+        self.datadir = datadir
+        self.backend = backend
+        self.shard_size = shard_size
+        os.makedirs(datadir, exist_ok=True)
+        self.index_path = os.path.join(datadir, 'index.csv')
+        new_index = not os.path.exists(self.index_path)
+        self.index_file = open(self.index_path, 'a', newline='')
+        self.index = csv.writer(self.index_file)
+        if new_index:
+            self.index.writerow(INDEX_FIELDS)
+        # continue numbering after any shards left by earlier runs
+        self.shard_number = len(glob.glob(os.path.join(datadir, 'shard_*')))
+        self.pending = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.encoding_seconds = 0.0
+        self.write_seconds = 0.0
+        self.encoded_frames = 0
+        self.bytes_written = 0
+
+    def record_spans(self, tracer):
+        '''Record the encoding and write time since the last call as spans of 'tracer', then reset the totals.'''
+        if self.encoded_frames or self.bytes_written:
+            tracer.add('encoding', self.encoding_seconds, frames=self.encoded_frames)
+            tracer.add('write', self.write_seconds, bytes_written=self.bytes_written)
+        self.reset_stats()
+
+    def add(self, frame, name, source='', row=0, col=0, label=''):
+        '''Queue one frame and its metadata, writing out the shard when it is full.'''
+        frame = np.ascontiguousarray(frame)
+        if self.backend == 'png':
+            start = time.perf_counter()
+            payload = encode_png(frame)
+            encoded = time.perf_counter()
+            with open(os.path.join(self.datadir, f"{name}.png"), 'wb') as f:
+                f.write(payload)
+            self.index.writerow([name, f"{name}.png", 0, source, row, col, label])
+            self.encoding_seconds += encoded - start
+            self.write_seconds += time.perf_counter() - encoded
+            self.encoded_frames += 1
+            self.bytes_written += len(payload)
+            return
+        # a shard holds frames of one shape only
+        if self.pending and self.pending[0][0].shape != frame.shape:
+            self.flush()
+        self.pending.append((frame, name, source, row, col, label))
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def extend(self, records):
+        '''Add the records collected by a FrameBuffer.'''
+        for record in records:
+            self.add(*record)
+
+    def flush(self):
+        '''Write the pending frames as one shard and append their index rows (png: just flush the index).'''
+        if not self.pending:
+            self.index_file.flush()
+            return
+        shard_name = f"shard_{self.shard_number:05d}{SHARD_EXTENSIONS[self.backend]}"
+        shard_path = os.path.join(self.datadir, shard_name)
+        temp_path = os.path.join(self.datadir, f".{shard_name}.tmp")
+        start = time.perf_counter()
+        if self.backend == 'tar':
+            payloads = [encode_png(frame) for frame, *_ in self.pending]
+        else:
+            frames = np.stack([record[0] for record in self.pending])
+        encoded = time.perf_counter()
+        if self.backend == 'npz':
+            with open(temp_path, 'wb') as f:
+                np.savez(f, frames=frames)
+        elif self.backend == 'hdf5':
+            with h5py.File(temp_path, 'w') as f:
+                f.create_dataset('frames', data=frames)
+        elif self.backend == 'tar':
+            with tarfile.open(temp_path, 'w') as tar:
+                for payload, (frame, name, *_) in zip(payloads, self.pending):
+                    info = tarfile.TarInfo(f"{name}.png")
+                    info.size = len(payload)
+                    tar.addfile(info, io.BytesIO(payload))
+        os.replace(temp_path, shard_path)
+        self.encoding_seconds += encoded - start
+        self.write_seconds += time.perf_counter() - encoded
+        self.encoded_frames += len(self.pending)
+        self.bytes_written += os.path.getsize(shard_path)
+        for position, (frame, name, source, row, col, label) in enumerate(self.pending):
+            self.index.writerow([name, shard_name, position, source, row, col, label])
+        self.index_file.flush()
+        self.shard_number += 1
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_index(datadir):
+    '''Read the index.csv of a frame directory as a list of dictionaries.'''
+    with open(os.path.join(datadir, 'index.csv'), 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def iter_frames(datadir):
+    '''
+    Yield (frame, index_row) for every frame in 'datadir', whichever backend wrote it.
+    Frames are read one whole shard at a time, in index order.
+    '''
+    rows = read_index(datadir)
+    start = 0
+    while start < len(rows):
+        shard_name = rows[start]['shard']
+        stop = start
+        while stop < len(rows) and rows[stop]['shard'] == shard_name:
+            stop += 1
+        shard_rows = rows[start:stop]
+        shard_path = os.path.join(datadir, shard_name)
+        if shard_name.endswith('.png'):
+            frames = [np.asarray(Image.open(shard_path))]
+        elif shard_name.endswith('.npz'):
+            with np.load(shard_path) as shard:
+                frames = shard['frames']
+        elif shard_name.endswith('.h5'):
+            if h5py is None:
+                raise ImportError("Reading .h5 shards needs h5py. Please install it using\npip install h5py")
+            with h5py.File(shard_path, 'r') as shard:
+                frames = shard['frames'][:]
+        elif shard_name.endswith('.tar'):
+            with tarfile.open(shard_path, 'r') as tar:
+                frames = [np.asarray(Image.open(io.BytesIO(tar.extractfile(member).read()))) for member in tar]
+        else:
+            raise ValueError(f"Unknown shard type: {shard_name}")
+        for row in shard_rows:
+            yield frames[int(row['position'])], row
+        start = stop
@@ -0,0 +1,113 @@
+'''
+Pure-Python reader for the slicer angles stored in binary IMOD model (.mod) files.
+
+This replaces the `imodinfo -a <modfile> | grep '^slicerAngle' | awk ...` pipeline in create_fm_images.py
+and create_negative_images.py, so no processes are launched, no temporary label CSV is written, and IMOD
+does not need to be loaded on the node.
+
+An IMOD model file is big-endian. It starts with the 8 byte ID "IMODV1.2" and a 232 byte model header, then
+a sequence of chunks, each starting with a 4 character ID. OBJT, CONT and MESH chunks have a fixed header
+(plus point/index data for CONT and MESH), IEOF ends the file, and every other chunk stores its size in bytes
+right after its ID. Slicer angles are in SLAN chunks:
+    int time, float angles[3] (about X, Y, Z), float center[3] (X, Y, Z), char label[32]
+See https://bio3d.colorado.edu/imod/doc/binspec.html for the full specification.
+
+Each slicer angle becomes one label row, in the same column order the awk pipeline produced:
+    x_rot y_rot z_rot x_center y_center z_center
+
+Dependencies: numpy
+'''
+import struct
+import numpy as np
+
+MODEL_HEADER_SIZE = 232
+OBJT_SIZE = 176
+CONT_HEADER_SIZE = 16
+MESH_HEADER_SIZE = 16
+SLAN_FORMAT = '>i3f3f32s'
+
+
+def parse_slicer_angles(buffer):
+    '''Parse the slicer angles out of the bytes of an IMOD model file. Returns an (n, 6) float64 array.'''
+    if len(buffer) < 8 + MODEL_HEADER_SIZE or buffer[:4] != b'IMOD':
+        raise ValueError("Not an IMOD binary model file.")
+    rows = []
+    offset = 8 + MODEL_HEADER_SIZE
+    try:
+        complete = _walk_chunks(buffer, offset, rows)
+    except struct.error as e:
+        raise ValueError(f"Truncated IMOD model file: {e}")
+    if not complete:
+        raise ValueError("Truncated IMOD model file: no IEOF chunk.")
+    return np.array(rows, dtype=np.float64).reshape(-1, 6)
+
+
+def _walk_chunks(buffer, offset, rows):
+    '''Walk the chunks after the model header, appending one row per SLAN chunk to 'rows'. Returns True at IEOF.'''
+    end = len(buffer)
+    while offset + 4 <= end:
+        chunk_id = buffer[offset:offset + 4]
+        offset += 4
+        if chunk_id == b'IEOF':
+            return True
+        elif chunk_id == b'OBJT':
+            offset += OBJT_SIZE
+        elif chunk_id == b'CONT':
+            psize, = struct.unpack_from('>i', buffer, offset)
+            offset += CONT_HEADER_SIZE + 12 * psize
+        elif chunk_id == b'MESH':
+            vsize, lsize = struct.unpack_from('>ii', buffer, offset)
+            offset += MESH_HEADER_SIZE + 12 * vsize + 4 * lsize
+        else:
+            size, = struct.unpack_from('>i', buffer, offset)
+            offset += 4
+            if size < 0 or offset + size > end:
+                raise ValueError(f"Corrupt chunk {chunk_id!r} in IMOD model file.")
+            if chunk_id == b'SLAN':
+                time, x_rot, y_rot, z_rot, x_center, y_center, z_center, label = struct.unpack_from(SLAN_FORMAT, buffer, offset)
+                rows.append((x_rot, y_rot, z_rot, x_center, y_center, z_center))
+            offset += size
+    return False
+
+
+def read_slicer_angles(modfile):
+    '''
+    Read the slicer angles and centers of one .mod file.
+
+    Returns an (n, 6) float64 array with one [x_rot, y_rot, z_rot, x_center, y_center, z_center] row per
+    slicer angle (n may be 0). Raises OSError if the file cannot be read and ValueError if it is not a
+    valid binary IMOD model.
+    '''
+    with open(modfile, 'rb') as f:
+        buffer = f.read()
+    return parse_slicer_angles(buffer)
+
+
+def read_slicer_angles_batch(modfiles):
+    '''
+    Read the slicer angles of many .mod files in this process.
+
+    Returns a dictionary mapping each readable model file to its (n, 6) label array; files that fail to parse
+    are reported and left out.
+    '''
+    labels = dict()
+    for modfile in modfiles:
+        try:
+            labels[modfile] = read_slicer_angles(modfile)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read slicer angles from {modfile}: {e}")
+    return labels
+
+
+def write_slicer_angles(modfile, labels):
+    '''
+    Write label rows as the SLAN chunks of a minimal binary IMOD model (empty model header, no objects).
+    This is enough for read_slicer_angles, e.g. for test and benchmark fixtures, but not a complete model for 3dmod.
+    '''
+    chunks = [b'IMODV1.2', bytes(MODEL_HEADER_SIZE)]
+    for x_rot, y_rot, z_rot, x_center, y_center, z_center in np.reshape(labels, (-1, 6)):
+        chunks.append(b'SLAN' + struct.pack('>i', struct.calcsize(SLAN_FORMAT)))
+        chunks.append(struct.pack(SLAN_FORMAT, 0, x_rot, y_rot, z_rot, x_center, y_center, z_center, b''))
+    chunks.append(b'IEOF')
+    with open(modfile, 'wb') as f:
+        f.write(b''.join(chunks))
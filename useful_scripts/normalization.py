@@ -0,0 +1,74 @@
+'''
+Shared percentile normalization for the frame-generation scripts.
+
+robust_normalize_image used to be duplicated in create_fm_images.py and create_negative_images.py, and each call
+did a full sort (np.percentile), an np.clip copy and a float64 expression with several temporaries before the
+uint8 cast. Here the percentiles come from a selection (np.partition, O(n) instead of O(n log n)) with the same
+linear interpolation np.percentile uses, and the scaling is done in place in one float32 scratch buffer and
+written straight into a (preallocated) uint8 output. A whole batch of frames can be normalized at once, with
+statistics either per frame or over the whole batch (e.g. all tiles of one tomogram).
+
+Dependencies: numpy
+'''
+import numpy as np
+
+
+def batch_percentiles(flat, q):
+    '''
+    Percentiles along the last axis of a 2D (n, m) array by selection instead of sorting.
+    Matches np.percentile(flat, q, axis=1) with the default 'linear' method. Returns a (len(q), n) array.
+    '''
+    m = flat.shape[-1]
+    positions = np.asarray(q, dtype=np.float64) / 100 * (m - 1)
+    below = np.floor(positions).astype(np.intp)
+    above = np.minimum(below + 1, m - 1)
+    fraction = (positions - below).astype(np.float32)
+    kth = np.unique(np.concatenate([below, above]))
+    selected = np.partition(flat, kth, axis=-1)
+    low_values = selected[:, below].T
+    high_values = selected[:, above].T
+    return low_values + (high_values - low_values) * fraction[:, None]
+
+
+def robust_normalize_batch(frames, per_tomogram=False, out=None, lower=1, upper=99):
+    '''
+    Clip frames to their lower/upper percentiles and scale them to uint8.
+
+    Parameters:
+    - frames: (n, height, width) or (height, width) array.
+    - per_tomogram: if True, use one pair of percentiles over the whole batch instead of one pair per frame.
+    - out: optional preallocated uint8 array of the same shape to write into.
+    - lower, upper: percentiles to clip to (1 and 99 by default).
+
+    Returns:
+    - The uint8 array ('out' if given). Frames with no contrast (upper == lower percentile) come out as zeros.
+    '''
+    frames = np.asarray(frames)
+    if out is None:
+        out = np.empty(frames.shape, dtype=np.uint8)
+    single = frames.ndim == 2
+    if single:
+        frames = frames[None]
+    batch_out = out[None] if single else out
+
+    n_frames = frames.shape[0]
+    flat = frames.reshape(1 if per_tomogram else n_frames, -1)
+    p_low, p_high = batch_percentiles(flat, [lower, upper])
+    spread = p_high - p_low
+    scale = np.divide(255, spread, out=np.zeros_like(spread), where=spread > 0)
+    p_low = p_low[:, None, None]
+    p_high = p_high[:, None, None]
+    scale = scale[:, None, None]
+
+    # one float32 scratch buffer; every step below works in place on it
+    scratch = np.empty(frames.shape, dtype=np.float32)
+    np.clip(frames, p_low, p_high, out=scratch)
+    scratch -= p_low
+    scratch *= scale
+    np.copyto(batch_out, scratch, casting='unsafe')
+    return out
+
+
+def robust_normalize_image(image, out=None):
+    '''Normalize one 2D frame to uint8, clipped to its own 1st/99th percentiles.'''
+    return robust_normalize_batch(image, out=out)
@@ -1,69 +1,245 @@
+'''
+Keyboard-driven triage of frame images: accept the good ones into a destination directory.
+
+Images are decoded and resized by a pool of background threads a few images ahead of the one on screen, and the
+results are kept in a bounded LRU cache, so each keypress only swaps in an image that is already prepared. Tk
+objects (PhotoImage) are only ever created on the main thread. Accepted images are hardlinked (with --link) or
+copied into the destination directory, and every decision is appended to decisions.tsv there, so a session
+can be stopped at any time and a rerun picks up with the first undecided image.
+
+Keys, single image mode: 'p' accept, 'q' reject and go to the next image.
+Keys, grid mode (--grid ROWSxCOLS): click tiles to mark them, 'p' accepts the marked tiles and rejects the rest
+of the page, 'q' rejects the whole page.
+
+Usage:
+python select_imgs_gui.py [source directory] [destination directory] [--grid 4x6] [--link] [--prefetch 64]
+
+Dependencies: PIL
+'''
 import os
 import shutil
-from tkinter import Tk, Label, Button, PhotoImage
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import Tk, Label, Button, Frame
 from PIL import Image, ImageTk
 
-# Path to the directories
-source_directory = '~/Research/biophysics/all_imgs_neg'
-destination_directory = '~/Research/biophysics/my_negative_images/'
-
-# Make sure the destination directory exists
-if not os.path.exists(destination_directory):
-    os.makedirs(destination_directory)
-
-# List all files in the source directory
-images = [file for file in os.listdir(source_directory) if file.endswith(('png', 'jpg', 'jpeg', 'gif'))]
-current_image_index = 0
-
-def show_next_image(advance=True):
-    global current_image_index
-    if advance:
-        current_image_index += 1
-    if current_image_index >= len(images):
-        print("Finished processing all images.")
-        root.quit()  # Quit the application when the last image is reached
-        return
-    image_path = os.path.join(source_directory, images[current_image_index])
-    load_image(image_path)
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif')
+MANIFEST_NAME = 'decisions.tsv'
+
+
+def decode_image(path, size):
+    '''Load and resize one image to (size, size). Runs in the background threads.'''
+    with Image.open(path) as img:
+        img.load()
+        return img.resize((size, size), Image.LANCZOS)
+
+
+class ImagePrefetcher:
+    '''
+    Decode images ahead of time on a thread pool and keep at most 'max_cached' of them, least recently used first
+    out. Entries start as futures of resized PIL images and become PhotoImages the first time get() is called.
+    '''
+    def __init__(self, paths, size, max_cached=256, n_workers=4):
+        self.paths = paths
+        self.size = size
+        self.max_cached = max_cached
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.cache = OrderedDict()
+
+    def request(self, index):
+        if index >= len(self.paths):
+            return
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return
+        self.cache[index] = self.executor.submit(decode_image, self.paths[index], self.size)
+        while len(self.cache) > self.max_cached:
+            _, entry = self.cache.popitem(last=False)
+            if not isinstance(entry, ImageTk.PhotoImage):
+                entry.cancel()
+
+    def prefetch(self, start, count):
+        for index in range(start, min(start + count, len(self.paths))):
+            self.request(index)
+
+    def get(self, index):
+        '''PhotoImage for image 'index'. Must be called from the Tk main thread.'''
+        self.request(index)
+        entry = self.cache[index]
+        if not isinstance(entry, ImageTk.PhotoImage):
+            entry = ImageTk.PhotoImage(entry.result())
+            self.cache[index] = entry
+        return entry
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-def copy_image():
-    source_path = os.path.join(source_directory, images[current_image_index])
-    destination_path = os.path.join(destination_directory, images[current_image_index])
+
+def load_decisions(manifest_path):
+    '''Names of the images already accepted or rejected in earlier sessions.'''
+    decided = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) >= 2:
+                    decided.add(parts[0])
+    return decided
+
+
+def place_image(source_path, destination_path, link=False):
+    '''Hardlink (falling back to a copy across file systems) or copy an accepted image.'''
+    if os.path.exists(destination_path):
+        return
+    if link:
+        try:
+            os.link(source_path, destination_path)
+            return
+        except OSError:
+            pass
     shutil.copy2(source_path, destination_path)
-    print(f"Copied: {images[current_image_index]}")
-    show_next_image()
 
-def load_image(image_path):
-    img = Image.open(image_path)
-    img = img.resize((500, 500), Image.ANTIALIAS)  # Resize the image, if necessary
-    img = ImageTk.PhotoImage(img)
-    image_label.configure(image=img)
-    image_label.image = img
 
-def on_key(event):
-    if event.keysym.lower() == 'p':
-        copy_image()
-    elif event.keysym.lower() == 'q':
-        show_next_image()
+class Triage:
+    '''The viewer: shows one image or a grid page at a time and records a decision for every image shown.'''
+    def __init__(self, root, source_directory, destination_directory, names, rows=1, cols=1, size=500,
+                 link=False, n_prefetch=64):
+        self.root = root
+        self.source_directory = source_directory
+        self.destination_directory = destination_directory
+        self.names = names
+        self.rows = rows
+        self.cols = cols
+        self.per_page = rows * cols
+        self.link = link
+        self.n_prefetch = max(n_prefetch, self.per_page)
+        tile_size = size if self.per_page == 1 else size // max(rows, cols)
+        paths = [os.path.join(source_directory, name) for name in names]
+        self.prefetcher = ImagePrefetcher(paths, tile_size, max_cached=max(256, 4 * self.n_prefetch))
+        self.manifest = open(os.path.join(destination_directory, MANIFEST_NAME), 'a')
+        self.position = 0
+        self.marked = set()
+
+        grid = Frame(root)
+        grid.pack()
+        self.tiles = []
+        for k in range(self.per_page):
+            tile = Label(grid, borderwidth=3, relief='flat')
+            tile.grid(row=k // cols, column=k % cols, padx=1, pady=1)
+            if self.per_page > 1:
+                tile.bind('<Button-1>', lambda event, k=k: self.toggle(k))
+            self.tiles.append(tile)
+        if self.per_page == 1:
+            Button(root, text="Next Image (Press 'q')", command=self.reject_page).pack(side='left', padx=10, pady=10)
+            Button(root, text="Copy Image (Press 'p')", command=self.accept_page).pack(side='right', padx=10, pady=10)
+        else:
+            Button(root, text="Reject Page (Press 'q')", command=self.reject_page).pack(side='left', padx=10, pady=10)
+            Button(root, text="Accept Marked (Press 'p')", command=self.accept_page).pack(side='right', padx=10, pady=10)
+        root.bind('<Key>', self.on_key)
+        root.protocol('WM_DELETE_WINDOW', self.quit)
+        self.show_page()
+
+    def page(self):
+        return range(self.position, min(self.position + self.per_page, len(self.names)))
+
+    def show_page(self):
+        if self.position >= len(self.names):
+            print("Finished processing all images.")
+            self.quit()  # Quit the application when the last image is reached
+            return
+        self.marked = set()
+        # queue the following pages before blocking on this one
+        self.prefetcher.prefetch(self.position, self.n_prefetch)
+        indices = list(self.page())
+        for k, tile in enumerate(self.tiles):
+            if k < len(indices):
+                img = self.prefetcher.get(indices[k])
+                tile.configure(image=img, relief='flat')
+                tile.image = img
+            else:
+                tile.configure(image='', relief='flat')
+                tile.image = None
+        self.root.title(f'Image Viewer ({self.position + 1}/{len(self.names)})')
+
+    def toggle(self, k):
+        if self.position + k >= len(self.names):
+            return
+        if k in self.marked:
+            self.marked.discard(k)
+            self.tiles[k].configure(relief='flat')
+        else:
+            self.marked.add(k)
+            self.tiles[k].configure(relief='solid')
+
+    def record(self, index, accepted):
+        name = self.names[index]
+        if accepted:
+            place_image(os.path.join(self.source_directory, name),
+                        os.path.join(self.destination_directory, name), self.link)
+            print(f"Copied: {name}")
+        self.manifest.write(f"{name}\t{'accepted' if accepted else 'rejected'}\n")
+
+    def accept_page(self):
+        # a single image is accepted outright, a grid page accepts only the marked tiles
+        for k, index in enumerate(self.page()):
+            self.record(index, self.per_page == 1 or k in self.marked)
+        self.next_page()
+
+    def reject_page(self):
+        for index in self.page():
+            self.record(index, False)
+        self.next_page()
+
+    def next_page(self):
+        self.manifest.flush()
+        self.position += self.per_page
+        self.show_page()
+
+    def on_key(self, event):
+        if event.keysym.lower() == 'p':
+            self.accept_page()
+        elif event.keysym.lower() == 'q':
+            self.reject_page()
 
-# Set up the GUI
-root = Tk()
-root.title('Image Viewer')
+    def quit(self):
+        self.manifest.close()
+        self.prefetcher.close()
+        self.root.quit()
 
-image_label = Label(root)
-image_label.pack()
 
-# Buttons for actions
-next_button = Button(root, text="Next Image (Press 'q')", command=lambda: show_next_image())
-next_button.pack(side='left', padx=10, pady=10)
+def main(source_directory, destination_directory, grid='1x1', size=500, link=False, n_prefetch=64):
+    source_directory = os.path.expanduser(source_directory)
+    destination_directory = os.path.expanduser(destination_directory)
+    # Make sure the destination directory exists
+    os.makedirs(destination_directory, exist_ok=True)
+    rows, cols = (int(n) for n in grid.lower().split('x'))
 
-copy_button = Button(root, text="Copy Image (Press 'p')", command=copy_image)
-copy_button.pack(side='right', padx=10, pady=10)
+    # List all undecided images in the source directory, in a stable order
+    decided = load_decisions(os.path.join(destination_directory, MANIFEST_NAME))
+    with os.scandir(source_directory) as it:
+        names = sorted(entry.name for entry in it
+                       if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.name not in decided)
+    print(f"{len(names)} images to review ({len(decided)} decided in earlier sessions).")
 
-# Bind key events to the root window for keyboard shortcuts
-root.bind('<Key>', on_key)
+    # Set up the GUI
+    root = Tk()
+    root.title('Image Viewer')
+    Triage(root, source_directory, destination_directory, names, rows, cols, size, link, n_prefetch)
+    root.mainloop()
 
-# Display the first image
-show_next_image(advance=False)
 
-root.mainloop()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accept or reject frame images from the keyboard.')
+    parser.add_argument('source', nargs='?', default='~/Research/biophysics/all_imgs_neg',
+                        help='Directory of images to review.')
+    parser.add_argument('destination', nargs='?', default='~/Research/biophysics/my_negative_images/',
+                        help='Directory accepted images go to; decisions.tsv is kept here.')
+    parser.add_argument('-g', '--grid', default='1x1', help="Show ROWSxCOLS tiles per page (default: 1x1).")
+    parser.add_argument('-s', '--size', type=int, default=500, help='Size of the display area in pixels (default: 500).')
+    parser.add_argument('-l', '--link', action='store_true',
+                        help='Hardlink accepted images instead of copying them (falls back to a copy across file systems).')
+    parser.add_argument('-n', '--prefetch', type=int, default=64,
+                        help='Number of images decoded ahead of the one on screen (default: 64).')
+    args = parser.parse_args()
+    main(args.source, args.destination, args.grid, args.size, args.link, args.prefetch)
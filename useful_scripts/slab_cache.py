@@ -0,0 +1,141 @@
+'''
+Content-addressed cache of averaged slabs (.arec files) shared by create_fm_images.py, create_negative_images.py
+and any other tool that needs the rotated, averaged slab around a label.
+
+Slabs are keyed by the identity of the source tomogram (real path, size and mtime), the label row (angles and
+center), the slab thickness and the output shape, so the same rec/mod pair maps to the same entry no matter which
+script or loop index asked for it. Rerunning a dataset build with new tiling parameters therefore skips the
+rotation step entirely. The cache directory is bounded in size: each hit refreshes the entry's access time, and
+the least recently used entries are deleted once the total size goes over 'max_bytes'. Entries are written under a
+temporary name and renamed into place, so several processes can share one cache directory. Each process only
+counts its own writes between scans, so with many writers the cache can overshoot 'max_bytes' briefly until the
+next eviction rescans the directory.
+
+Other MRC files can be cached the same way with get_path/put_file. binning.py keeps binned tomograms in their own
+SlabCache (a 'binned' subdirectory), which are memory-mapped from the cache instead of being loaded. Hits leave the
+mtime of an entry alone, so slabs cut from a cached binned tomogram keep hitting under slab_key.
+
+Dependencies: numpy, mrcfile
+'''
+import os
+import time
+import hashlib
+import numpy as np
+import mrcfile
+
+# bump when the slab computation changes so stale entries are no longer hit
+CACHE_VERSION = 3
+
+
+def slab_key(rec_file, label, thickness, out_shape=None):
+    '''Hash of everything that determines the averaged slab for one label of one tomogram.'''
+    stat = os.stat(rec_file)
+    label = np.round(np.asarray(label, dtype=np.float64), 4)
+    parts = [CACHE_VERSION, os.path.realpath(rec_file), stat.st_size, stat.st_mtime_ns,
+             label.tolist(), int(thickness), None if out_shape is None else tuple(out_shape)]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def mark_used(path):
+    '''Set the access time of 'path' to now, keeping its mtime (which slab_key hashes).'''
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+
+class SlabCache:
+    '''Size-bounded LRU cache of averaged slabs stored as .arec (MRC) files in 'cache_dir'.'''
+    def __init__(self, cache_dir, max_bytes=50 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # scanned on the first write, so read-only use never lists the directory
+        self.total_bytes = None
+
+    def _entries(self):
+        '''(path, size, last use) of every cache entry.'''
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.arec'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_atime))
+        return entries
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.arec")
+
+    def get(self, key):
+        '''Return the cached slab for 'key', or None on a miss.'''
+        path = self.path(key)
+        try:
+            with mrcfile.open(path, permissive=True) as mrc:
+                slab = np.array(mrc.data)
+            mark_used(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return slab
+
+    def get_path(self, key):
+        '''Path of the entry for 'key' without loading it (e.g. to memory-map a whole volume), or None on a miss.'''
+        path = self.path(key)
+        try:
+            mark_used(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, slab):
+        '''Store a slab under 'key' and evict old entries if the cache is over budget.'''
+        temp_path = self.temp_path(key)
+        with mrcfile.new(temp_path, overwrite=True) as mrc:
+            mrc.set_data(np.asarray(slab, dtype=np.float32))
+        self.put_file(key, temp_path)
+
+    def temp_path(self, key):
+        '''Where to write an entry before put_file moves it into place.'''
+        return f"{self.path(key)}.{os.getpid()}.tmp"
+
+    def put_file(self, key, temp_path):
+        '''Move a finished MRC file into the cache under 'key' and evict old entries if the cache is over budget.'''
+        path = self.path(key)
+        os.replace(temp_path, path)
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self._entries())
+        else:
+            self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''Delete least recently used entries until the cache fits in max_bytes.'''
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+    def get_or_compute(self, rec_file, label, thickness, compute, out_shape=None):
+        '''Return the cached slab for this label of 'rec_file', calling compute() and caching it on a miss.'''
+        key = slab_key(rec_file, label, thickness, out_shape)
+        slab = self.get(key)
+        if slab is None:
+            slab = compute()
+            self.put(key, slab)
+        return slab
+
+
+_caches = dict()
+
+
+def get_cache(cache_dir, max_bytes=50 * 2**30):
+    '''Return this process's SlabCache for 'cache_dir', creating it on first use (handy in pool workers).'''
+    if cache_dir not in _caches:
+        _caches[cache_dir] = SlabCache(cache_dir, max_bytes)
+    return _caches[cache_dir]
@@ -0,0 +1,270 @@
+'''
+In-process replacement for the IMOD `rotatevol` call used by create_fm_images.py and
+create_negative_images.py. Instead of writing a full rotated volume to disk and averaging it along z,
+this resamples only the `thickness`-voxel slab around the label center and averages it in memory.
+
+The rotation follows rotatevol's conventions: the label angles are applied about Z, then Y, then X, and
+the output slab is centered on the label center, so the motor ends up in the middle of the averaged image.
+Only the bounding box of the input that the slab touches is read from the (memory-mapped) volume.
+
+With a memory budget ('max_bytes'), a tomogram whose slabs would need more working memory than that is processed
+out of core: each slab is resampled in square blocks of the output image, and for every block only the z/y/x box
+of the input that block touches is read from the memory map. The block size is the largest that keeps the input
+box and the resampling buffers within the budget. So peak memory depends on the budget and the slab size (the
+finished float32 slab comes on top), not on the size of the tomogram. Like rotatevol, both paths fill the parts of
+a slab outside the volume with the volume's mean, estimated once per call from evenly spaced z planes (about
+FILL_SAMPLE_BYTES of them, whatever the budget), so with the default linear interpolation the blocks are equal to
+the in-memory result to float tolerance.
+
+Dependencies: numpy, scipy
+'''
+import time
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+# default working-memory budget for the slabs of one tomogram
+DEFAULT_MAX_BYTES = 2 * 2**30
+# working memory per output pixel while resampling a plane: float32 (z, y, x) coordinates and the resampled plane
+PLANE_BYTES_PER_PIXEL = 16
+# smallest output block edge the out-of-core path goes down to, whatever the budget
+MIN_BLOCK = 16
+# how much of the volume is sampled for the mean that fills the parts of slabs outside it
+FILL_SAMPLE_BYTES = 32 * 2**20
+
+
+def rotation_matrix(x_rot, y_rot, z_rot):
+    '''Rotation matrix (x, y, z order) for rotations about Z, then Y, then X, in degrees.'''
+    ax, ay, az = np.deg2rad([x_rot, y_rot, z_rot])
+    rx = np.array([[1, 0, 0],
+                   [0, np.cos(ax), -np.sin(ax)],
+                   [0, np.sin(ax), np.cos(ax)]])
+    ry = np.array([[np.cos(ay), 0, np.sin(ay)],
+                   [0, 1, 0],
+                   [-np.sin(ay), 0, np.cos(ay)]])
+    rz = np.array([[np.cos(az), -np.sin(az), 0],
+                   [np.sin(az), np.cos(az), 0],
+                   [0, 0, 1]])
+    return rx @ ry @ rz
+
+
+def slab_coordinates(label, thickness, height, width):
+    '''
+    Map the output slab grid back into input volume coordinates.
+
+    Returns two functions of an optional block of output rows and columns (slices, the whole plane by default):
+    plane(k, rows, cols) gives the (z, y, x) input coordinates of that block of output plane k as a
+    (3, n_rows, n_cols) float32 array, and bbox(rows, cols) the (3, 2) bounding box [min, max] in input space of
+    that block through all planes of the slab.
+    '''
+    x_rot, y_rot, z_rot = label[:3]
+    center = np.asarray(label[3:6], dtype=np.float64)
+    # output -> input is the inverse (transpose) of the forward rotation
+    inverse = rotation_matrix(x_rot, y_rot, z_rot).T
+    xs = np.arange(width, dtype=np.float64) - width // 2
+    ys = np.arange(height, dtype=np.float64) - height // 2
+    zs = np.arange(thickness, dtype=np.float64) - thickness // 2
+
+    def plane(k, rows=slice(None), cols=slice(None)):
+        # input = center + inverse @ (x, y, z), built from the separable x and y terms
+        x_term = inverse[:, 0, None] * xs[None, cols]
+        y_term = inverse[:, 1, None] * ys[None, rows]
+        offset = center + inverse[:, 2] * zs[k]
+        coords = x_term[:, None, :] + y_term[:, :, None] + offset[:, None, None]
+        return coords[::-1].astype(np.float32)  # (x, y, z) -> (z, y, x) for indexing
+
+    def bbox(rows=slice(None), cols=slice(None)):
+        block_xs = xs[cols]
+        block_ys = ys[rows]
+        corners = np.array([[x, y, z] for x in (block_xs[0], block_xs[-1]) for y in (block_ys[0], block_ys[-1])
+                            for z in (zs[0], zs[-1])])
+        corners = center + corners @ inverse.T
+        return np.stack([corners.min(axis=0), corners.max(axis=0)], axis=1)[::-1]
+
+    return plane, bbox
+
+
+def box_limits(shape, bbox):
+    '''Integer [lo, hi) limits of a (3, 2) input bounding box, with a voxel of margin for interpolation, in 'shape'.'''
+    lo = np.maximum(np.floor(bbox[:, 0]).astype(int) - 1, 0)
+    hi = np.minimum(np.ceil(bbox[:, 1]).astype(int) + 2, shape)
+    return lo, hi
+
+
+def read_box(volume, lo, hi, timings):
+    '''Copy volume[lo:hi] out of the (memory-mapped) volume, adding the time and bytes to 'timings'.'''
+    start = time.perf_counter()
+    box = np.ascontiguousarray(volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+    timings['read'] += time.perf_counter() - start
+    timings['bytes_read'] += box.nbytes
+    return box
+
+
+def box_mean(volume, lo, hi, max_bytes, timings, sample_bytes=None):
+    '''
+    Mean of volume[lo:hi], read a group of z planes at a time with each read under 'max_bytes'. With
+    'sample_bytes', only every n-th z plane is read if the box is larger than that, so the estimate reads about
+    'sample_bytes'.
+    '''
+    n_planes = hi[0] - lo[0]
+    plane_bytes = max(int(np.prod(hi[1:] - lo[1:])) * volume.dtype.itemsize, 1)
+    step = 1 if sample_bytes is None else max(1, int(np.ceil(n_planes * plane_bytes / sample_bytes)))
+    group = max(1, max_bytes // plane_bytes) * step
+    total = 0.0
+    count = 0
+    for z in range(lo[0], hi[0], group):
+        start = time.perf_counter()
+        planes = np.asarray(volume[z:min(z + group, hi[0]):step, lo[1]:hi[1], lo[2]:hi[2]])
+        total += planes.sum(dtype=np.float64)
+        count += planes.size
+        timings['read'] += time.perf_counter() - start
+        timings['bytes_read'] += planes.nbytes
+    return total / count
+
+
+def volume_mean(volume, max_bytes, timings):
+    '''Estimated mean of the whole volume, the fill of slabs outside it (as in rotatevol).'''
+    return box_mean(volume, np.zeros(3, int), np.array(volume.shape), max_bytes, timings, FILL_SAMPLE_BYTES)
+
+
+def accumulate_planes(sub, lo, plane, thickness, fill, accum, order, timings, rows=slice(None), cols=slice(None)):
+    '''
+    Resample every plane of one slab (or of the rows/cols block of it) from 'sub', the input box starting at 'lo',
+    and add them into 'accum', adding the rotation and averaging time to 'timings'.
+    '''
+    resampled = np.empty(accum.shape, dtype=np.float32)
+    offset = lo.astype(np.float32)[:, None, None]
+    for k in range(thickness):
+        tick = time.perf_counter()
+        coords = plane(k, rows, cols)
+        coords -= offset
+        map_coordinates(sub, coords, output=resampled, order=order, mode='constant', cval=fill)
+        tock = time.perf_counter()
+        accum += resampled
+        timings['rotation'] += tock - tick
+        timings['averaging'] += time.perf_counter() - tock
+
+
+def slab_blocks(bbox, thickness, height, width, itemsize, max_bytes):
+    '''
+    Split a (height, width) output slab into square blocks, as large as possible while the input box a block
+    touches and the resampling buffers fit in 'max_bytes'. Returns a list of (rows, cols) slices.
+    '''
+    size = max(height, width)
+    while size > MIN_BLOCK:
+        rows, cols = min(size, height), min(size, width)
+        # the input box of a block has the same size wherever the block is, so measure the first one
+        box = bbox(slice(0, rows), slice(0, cols))
+        needed = np.prod(box[:, 1] - box[:, 0] + 3) * itemsize + rows * cols * PLANE_BYTES_PER_PIXEL
+        if needed <= max_bytes:
+            break
+        size //= 2
+    return [(slice(r, min(r + size, height)), slice(c, min(c + size, width)))
+            for r in range(0, height, size) for c in range(0, width, size)]
+
+
+def slab_average_out_of_core(volume, plane, bbox, thickness, height, width, order, fill, max_bytes, timings):
+    '''Averaged rotated slab computed block by block, reading only the input box of each block.'''
+    lo, hi = box_limits(volume.shape, bbox())
+    if np.any(hi <= lo):
+        # the slab lies entirely outside the volume
+        return np.full((height, width), fill, dtype=np.float32)
+    blocks = slab_blocks(bbox, thickness, height, width, volume.dtype.itemsize, max_bytes)
+    timings['blocks'] += len(blocks)
+    accum = np.zeros((height, width), dtype=np.float32)
+    for rows, cols in blocks:
+        lo, hi = box_limits(volume.shape, bbox(rows, cols))
+        if np.any(hi <= lo):
+            accum[rows, cols] = fill * thickness
+            continue
+        sub = read_box(volume, lo, hi, timings)
+        accumulate_planes(sub, lo, plane, thickness, fill, accum[rows, cols], order, timings, rows, cols)
+    accum /= thickness
+    return accum
+
+
+def rotated_slab_averages(volume, labels, thickness, out_shape=None, order=1, tracer=None, max_bytes=None):
+    '''
+    Averaged rotated slab for every label row of one volume, reading the volume only once.
+
+    The union of the slabs' bounding boxes is read from the (memory-mapped) volume in a single pass, in the
+    volume's own dtype, and every slab is resampled from that copy. If that copy and the resampling buffers would
+    need more than 'max_bytes', each slab is instead computed out of core, block by block (see the module
+    docstring). Returns a list of float32 (height, width) arrays, one per label, in label order. See
+    rotated_slab_average for the other parameters. With a tracing.Tracer, the read, rotation and averaging time
+    (summed over all slabs and blocks) are recorded as spans.
+    '''
+    labels = np.reshape(labels, (-1, 6))
+    height, width = out_shape if out_shape is not None else volume.shape[1:]
+    if len(labels) == 0:
+        return []
+    planes, bboxes = zip(*[slab_coordinates(label, thickness, height, width) for label in labels])
+
+    # read only the part of the volume the slabs can touch (plus a voxel of margin for interpolation)
+    limits = [box_limits(volume.shape, bbox()) for bbox in bboxes]
+    inside = [(own_lo, own_hi) for own_lo, own_hi in limits if np.all(own_hi > own_lo)] or [(np.zeros(3, int),) * 2]
+    lo = np.min([own_lo for own_lo, _ in inside], axis=0)
+    hi = np.max([own_hi for _, own_hi in inside], axis=0)
+
+    started = time.time()
+    timings = {'read': 0.0, 'bytes_read': 0, 'rotation': 0.0, 'averaging': 0.0, 'blocks': 0}
+    needed = np.prod(hi - lo) * volume.dtype.itemsize + height * width * PLANE_BYTES_PER_PIXEL
+    # rotatevol fills areas outside the volume with its mean; the same sampled estimate is used on both paths
+    fill = volume_mean(volume, (max_bytes or DEFAULT_MAX_BYTES) // 4, timings)
+    if np.any(hi <= lo):
+        # every slab lies entirely outside the volume
+        slabs = [np.full((height, width), fill, dtype=np.float32) for _ in labels]
+    elif max_bytes is not None and needed > max_bytes:
+        slabs = [slab_average_out_of_core(volume, plane, bbox, thickness, height, width, order, fill, max_bytes,
+                                          timings)
+                 for plane, bbox in zip(planes, bboxes)]
+    else:
+        sub = read_box(volume, lo, hi, timings)
+        slabs = []
+        for plane, (own_lo, own_hi) in zip(planes, limits):
+            if np.any(own_hi <= own_lo):
+                # this slab lies entirely outside the volume
+                slabs.append(np.full((height, width), fill, dtype=np.float32))
+                continue
+            accum = np.zeros((height, width), dtype=np.float32)
+            accumulate_planes(sub, lo, plane, thickness, fill, accum, order, timings)
+            accum /= thickness
+            slabs.append(accum)
+    if tracer is not None:
+        tracer.add('read', timings['read'], start=started, bytes_read=timings['bytes_read'],
+                   blocks=timings['blocks'])
+        voxels = len(labels) * thickness * height * width
+        tracer.add('rotation', timings['rotation'], start=started + timings['read'], slabs=len(labels),
+                   voxels=voxels)
+        tracer.add('averaging', timings['averaging'], start=started + timings['read'] + timings['rotation'],
+                   slabs=len(labels))
+    return slabs
+
+
+def centers_in_slab(labels, reference, thickness, height, width):
+    '''
+    (x, y, z) position of every label center in the output grid of the slab rotated about label 'reference'.
+    Column 2 tells how far each motor is from the slab's middle plane, so callers can tell which motors the
+    averaged slab actually shows.
+    '''
+    labels = np.reshape(labels, (-1, 6))
+    forward = rotation_matrix(*labels[reference, :3])
+    offsets = (labels[:, 3:6] - labels[reference, 3:6]) @ forward.T
+    return offsets + np.array([width // 2, height // 2, thickness // 2])
+
+
+def rotated_slab_average(volume, label, thickness, out_shape=None, order=1, max_bytes=None):
+    '''
+    Average of the `thickness`-voxel slab of `volume` rotated by the label angles about the label center.
+
+    Parameters:
+    - volume: (z, y, x) array, typically the memory-mapped data of an MRC file.
+    - label: one row of slicer angles and center, [x_rot, y_rot, z_rot, x_center, y_center, z_center].
+    - thickness: number of rotated z planes to average.
+    - out_shape: (height, width) of the averaged image. Defaults to the y/x size of the volume.
+    - order: spline interpolation order passed to scipy.ndimage.map_coordinates.
+    - max_bytes: optional working-memory budget; larger slabs are computed out of core.
+
+    Returns:
+    - A float32 (height, width) array, equivalent to averaging the output of rotatevol along z.
+    '''
+    return rotated_slab_averages(volume, [label], thickness, out_shape, order, max_bytes=max_bytes)[0]
@@ -0,0 +1,49 @@
+'''
+Tests for the positive-frame cropping in create_fm_images.py, including slabs of binned tomograms.
+
+Usage:
+python -m pytest test_create_fm_images.py
+
+Dependencies: pytest, numpy, scipy, mrcfile
+'''
+import numpy as np
+import mrcfile
+from benchmark import make_fixture
+from binning import binned_tomogram
+from frame_writer import FrameBuffer
+from create_fm_images import averaged_slabs, get_frames_from_slab
+
+
+def crop(slab, size=256, num_frames=20):
+    buffer = FrameBuffer()
+    get_frames_from_slab(slab, num_frames, size, buffer, 'test')
+    return buffer.records
+
+
+def test_frames_stay_inside_small_and_non_square_slabs():
+    np.random.seed(0)
+    for shape in [(256, 256), (300, 260), (260, 900), (1000, 300)]:
+        records = crop(np.random.rand(*shape).astype(np.float32))
+        assert len(records) == 20
+        for frame, name, source, row, col, label in records:
+            assert frame.shape == (256, 256)
+            assert 0 <= row <= shape[0] - 256 and 0 <= col <= shape[1] - 256
+
+
+def test_slab_smaller_than_frame_is_skipped():
+    assert crop(np.zeros((200, 600), dtype=np.float32)) == []
+    assert crop(np.zeros((600, 200), dtype=np.float32)) == []
+
+
+def test_frames_from_binned_slab(tmp_path):
+    np.random.seed(0)
+    mod_file, rec_file, labels = make_fixture(str(tmp_path), shape=(40, 512, 512))
+    with mrcfile.open(rec_file, mode='r+') as mrc:
+        mrc.voxel_size = 5.0
+    # binning by 2 leaves a 256 x 256 slab, exactly one frame wide
+    volume_file, binned, factor = binned_tomogram(rec_file, labels, 10.0, cache_dir=str(tmp_path / 'cache'))
+    assert factor == 2
+    slab, = averaged_slabs(volume_file, binned, 15)
+    assert slab.shape == (256, 256)
+    records = crop(slab, num_frames=5)
+    assert [frame.shape for frame, *_ in records] == [(256, 256)] * 5
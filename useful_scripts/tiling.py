@@ -0,0 +1,84 @@
+'''
+Batched tile extraction for the averaged slabs used by create_negative_images.py.
+
+Instead of slicing, normalizing and flipping one tile at a time in nested Python loops, the slab is viewed as a
+(rows, cols, size, size) grid of tiles through strides (no copy), the exclusion regions around all motors are
+applied as one boolean mask over that grid, and the selected tiles are normalized to uint8 in a single vectorized pass
+(see normalization.py).
+
+Dependencies: numpy
+'''
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from normalization import robust_normalize_batch
+from tracing import traced
+
+
+def tile_grid(img, size, n_rows=None, n_cols=None):
+    '''
+    View a 2D image as a read-only (n_rows, n_cols, size, size) grid of non-overlapping tiles without copying.
+    Tile (i, j) is img[i*size:(i+1)*size, j*size:(j+1)*size]. Defaults to every whole tile that fits.
+    '''
+    img = np.asarray(img)
+    height, width = img.shape
+    if n_rows is None:
+        n_rows = height // size
+    if n_cols is None:
+        n_cols = width // size
+    row_stride, col_stride = img.strides
+    return as_strided(img, shape=(n_rows, n_cols, size, size),
+                      strides=(size * row_stride, size * col_stride, row_stride, col_stride),
+                      writeable=False)
+
+
+def exclusion_mask(n_rows, n_cols, size, centers, half_width=30):
+    '''
+    Boolean (n_rows, n_cols) mask of the tiles to keep: a tile is dropped when it overlaps the square exclusion
+    box of side 2*half_width around any of the (row, col) motor 'centers'. All motors are handled in one pass.
+    '''
+    row_starts = np.arange(n_rows)[:, None] * size
+    col_starts = np.arange(n_cols)[:, None] * size
+    keep = np.ones((n_rows, n_cols), dtype=bool)
+    centers = np.reshape(np.asarray(centers, dtype=np.float64), (-1, 2))
+    if len(centers) == 0:
+        return keep
+    # (tiles, motors) overlap tests along each axis, combined into a (rows, cols) grid
+    rows_hit = (row_starts < centers[None, :, 0] + half_width) & (row_starts + size > centers[None, :, 0] - half_width)
+    cols_hit = (col_starts < centers[None, :, 1] + half_width) & (col_starts + size > centers[None, :, 1] - half_width)
+    hit = np.einsum('im,jm->ij', rows_hit.astype(np.int32), cols_hit.astype(np.int32)) > 0
+    keep &= ~hit
+    return keep
+
+
+def extract_tiles(img, size, mask=None, n_rows=None, n_cols=None, flip=True, per_tomogram=False, tracer=None):
+    '''
+    Extract, normalize and (optionally) vertically flip the tiles of a 2D slab in one batch.
+
+    Parameters:
+    - img: 2D averaged slab.
+    - size: tile edge length in pixels.
+    - mask: optional boolean (n_rows, n_cols) array of tiles to keep, e.g. from exclusion_mask.
+    - n_rows, n_cols: size of the tile grid; defaults to every whole tile that fits.
+    - flip: flip each tile upside down, as the PNG writers have always done.
+    - per_tomogram: normalize with percentiles over all selected tiles instead of per tile.
+    - tracer: optional tracing.Tracer to record the tiling and normalization time.
+
+    Returns:
+    - frames: (n_selected, size, size) uint8 array.
+    - positions: (n_selected, 2) array of the (i, j) grid index of each frame.
+    '''
+    with traced(tracer, 'tiling') as span:
+        grid = tile_grid(img, size, n_rows, n_cols)
+        if mask is None:
+            mask = np.ones(grid.shape[:2], dtype=bool)
+        positions = np.argwhere(mask)
+        # fancy indexing copies only the selected tiles
+        tiles = grid[mask]
+        span['frames'] = len(tiles)
+    if len(tiles) == 0:
+        return np.empty((0, size, size), dtype=np.uint8), positions
+    with traced(tracer, 'normalization', frames=len(tiles)):
+        frames = robust_normalize_batch(tiles, per_tomogram=per_tomogram)
+        if flip:
+            frames = frames[:, ::-1, :]
+    return frames, positions
@@ -0,0 +1,124 @@
+'''
+Header-only catalog of the tomograms under a directory tree (e.g. FlagellarMotor_P2).
+
+Only the 1024-byte MRC header of each file is read, never the voxel data, and the headers are read in
+parallel since the scan is bound by file system latency. The result is saved as a small CSV table with one
+row per tomogram (path, shape, dtype, mode, voxel size, file size and mtime). Rerunning the builder reuses
+rows whose file size and mtime have not changed, so only new or modified tomograms are touched.
+
+The image scripts use the catalog to filter and plan work (e.g. skipping tomograms whose header can't be read)
+before any tomogram is opened.
+
+Usage:
+python tomo_catalog.py <directory to search> <catalog csv>
+
+Dependencies: mrcfile
+'''
+import os
+import sys
+import csv
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+import mrcfile
+from mrcfile.utils import data_dtype_from_header
+from discovery import scan_tree
+
+CATALOG_FIELDS = ['path', 'nz', 'ny', 'nx', 'mode', 'dtype', 'voxel_x', 'voxel_y', 'voxel_z', 'size', 'mtime']
+
+
+def read_header(path):
+    '''Read the shape, dtype, mode and voxel size of one MRC file from its header only.'''
+    stat = os.stat(path)
+    with mrcfile.open(path, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        voxel_size = mrc.voxel_size
+        return {
+            'path': path,
+            'nz': int(header.nz),
+            'ny': int(header.ny),
+            'nx': int(header.nx),
+            'mode': int(header.mode),
+            'dtype': data_dtype_from_header(header).name,
+            'voxel_x': float(voxel_size.x),
+            'voxel_y': float(voxel_size.y),
+            'voxel_z': float(voxel_size.z),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+        }
+
+
+def load_catalog(catalog_path):
+    '''Load a catalog CSV into a dictionary keyed by tomogram path. Missing catalogs are empty.'''
+    catalog = dict()
+    if not os.path.exists(catalog_path):
+        return catalog
+    with open(catalog_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            for key in ('nz', 'ny', 'nx', 'mode', 'size', 'mtime'):
+                row[key] = int(row[key])
+            for key in ('voxel_x', 'voxel_y', 'voxel_z'):
+                row[key] = float(row[key])
+            catalog[row['path']] = row
+    return catalog
+
+
+def save_catalog(catalog, catalog_path):
+    '''Write the catalog to CSV, replacing the file atomically so readers never see a partial table.'''
+    temp_path = f'{catalog_path}.tmp'
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CATALOG_FIELDS)
+        writer.writeheader()
+        for path in sorted(catalog):
+            writer.writerow(catalog[path])
+    os.replace(temp_path, catalog_path)
+
+
+def build_catalog(root_dir, catalog_path, pattern='*.rec', n_workers=16, listing=None):
+    '''
+    Scan 'root_dir' for files matching 'pattern' and catalog their MRC headers.
+
+    Rows already in 'catalog_path' are kept when the file's size and mtime are unchanged. Files that
+    cannot be read as MRC are left out and reported. Pass 'listing' (from discovery.scan_tree) to reuse
+    a directory scan instead of walking the tree again. Returns the catalog dictionary keyed by path.
+    '''
+    previous = load_catalog(catalog_path)
+    catalog = dict()
+    to_read = []
+    if listing is None:
+        listing = scan_tree(root_dir)
+    for dirpath, entry in listing.items():
+        for filename in fnmatch.filter(entry['files'], pattern):
+            path = os.path.join(dirpath, filename)
+            row = previous.get(path)
+            if row is not None:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if row['size'] == stat.st_size and row['mtime'] == stat.st_mtime_ns:
+                    catalog[path] = row
+                    continue
+            to_read.append(path)
+
+    def try_read(path):
+        try:
+            return read_header(path)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read header of {path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for row in executor.map(try_read, to_read):
+            if row is not None:
+                catalog[row['path']] = row
+
+    save_catalog(catalog, catalog_path)
+    return catalog
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python tomo_catalog.py <directory to search> <catalog csv>")
+        sys.exit(1)
+    catalog = build_catalog(sys.argv[1], sys.argv[2])
+    print(f"Cataloged {len(catalog)} tomograms in {sys.argv[2]}")
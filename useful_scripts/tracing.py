@@ -0,0 +1,205 @@
+'''
+Per-tomogram tracing for the frame-generation scripts.
+
+Every step of a run is recorded as a span: a plain dictionary with the tomogram it belongs to, the stage, when it
+started, how long it took, the bytes it read or wrote, the peak RSS of the process at its end, and (for skipped
+tomograms) the reason. Stages used by the scripts:
+- discovery:     scanning the tree and reading the tomogram headers (tomogram '')
+- labels:        reading the slicer angles from the .mod file
+- binning:       binning the tomogram to the target pixel size (see binning.py)
+- cache:         looking up averaged slabs in the slab cache
+- read:          copying the part of the tomogram the slabs touch out of the memory map
+- rotation:      resampling the rotated slab planes
+- averaging:     averaging the planes into a slab
+- tiling:        choosing and cutting out the frames
+- normalization: percentile normalization to uint8
+- encoding:      PNG/array encoding in the FrameWriter
+- write:         writing frames or shards to disk
+Worker processes collect their spans in a Tracer and return them with their frames; only the parent writes the
+spans, one JSON object per line, through a TraceLog. Peak RSS is the peak of the whole process so far
+(resource.getrusage), so in a reused pool worker it is the largest tomogram that worker has handled.
+
+The JSON lines can be turned into a Chrome trace (chrome://tracing or https://ui.perfetto.dev, one row per process)
+and summarized: time and bytes per stage, skip reasons, and the slowest tomograms with the stage that dominated
+each one, to tell whether a long SLURM run is bound by I/O, rotation or encoding.
+
+Usage:
+python tracing.py <trace.jsonl> [--chrome trace.json] [--top 10]
+
+Dependencies: none (resource, for peak RSS, is not available on Windows)
+'''
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process in MiB, or None where resource is unavailable.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+
+class Tracer:
+    '''
+    Collects the spans of one process. 'tomogram' is stamped on every span and can be changed between
+    tomograms. Spans are plain dictionaries, so a worker can return tracer.spans to the parent.
+    '''
+    def __init__(self, tomogram=''):
+        self.tomogram = tomogram
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage, **fields):
+        '''Time the body as one span. Yields the span dictionary, so the body can add e.g. bytes_read.'''
+        record = {'tomogram': self.tomogram, 'stage': stage, 'start': time.time(), 'seconds': 0.0, **fields}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.finish(record)
+
+    def add(self, stage, seconds, start=None, **fields):
+        '''Record a span whose time was accumulated by the caller (e.g. over the planes of a slab).'''
+        record = {'tomogram': self.tomogram, 'stage': stage,
+                  'start': time.time() - seconds if start is None else start, 'seconds': seconds, **fields}
+        self.finish(record)
+
+    def skip(self, stage, reason, **fields):
+        '''Record that this tomogram was skipped at 'stage' and why.'''
+        self.add(stage, 0.0, skipped=reason, **fields)
+
+    def finish(self, record):
+        record['pid'] = os.getpid()
+        record['peak_rss_mb'] = peak_rss_mb()
+        self.spans.append(record)
+
+    def drain(self):
+        '''Return the spans collected so far and start a new list.'''
+        spans = self.spans
+        self.spans = []
+        return spans
+
+
+@contextmanager
+def traced(tracer, stage, **fields):
+    '''tracer.span(stage), or a no-op that still yields a dictionary to fill in when 'tracer' is None.'''
+    if tracer is None:
+        yield dict(fields)
+    else:
+        with tracer.span(stage, **fields) as record:
+            yield record
+
+
+class TraceLog:
+    '''Appends spans to a JSON-lines file, flushing after every batch so a killed job keeps its trace.'''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write(self, spans):
+        for record in spans:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_spans(path):
+    '''Read the spans of a JSON-lines trace, ignoring a truncated last line.'''
+    spans = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return spans
+
+
+def write_chrome_trace(spans, path):
+    '''Write the spans in the Chrome trace event format, with one row per process.'''
+    events = []
+    for record in spans:
+        args = {key: value for key, value in record.items() if key not in ('stage', 'start', 'seconds', 'pid')}
+        events.append({'name': record['stage'], 'cat': 'pipeline', 'ph': 'X',
+                       'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6,
+                       'pid': record.get('pid', 0), 'tid': 0, 'args': args})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize(spans, top=10):
+    '''Return the summary report of a trace as text: stage breakdown, skip reasons and slowest tomograms.'''
+    stages = defaultdict(lambda: {'seconds': 0.0, 'count': 0, 'bytes_read': 0, 'bytes_written': 0})
+    tomograms = defaultdict(lambda: defaultdict(float))
+    skips = defaultdict(int)
+    peak_rss = 0.0
+    for record in spans:
+        stage = stages[record['stage']]
+        stage['seconds'] += record['seconds']
+        stage['count'] += 1
+        stage['bytes_read'] += record.get('bytes_read', 0)
+        stage['bytes_written'] += record.get('bytes_written', 0)
+        if record['tomogram']:
+            tomograms[record['tomogram']][record['stage']] += record['seconds']
+        if 'skipped' in record:
+            skips[record['skipped']] += 1
+        peak_rss = max(peak_rss, record.get('peak_rss_mb') or 0.0)
+
+    lines = []
+    total = sum(stage['seconds'] for stage in stages.values())
+    if spans:
+        wall = max(r['start'] + r['seconds'] for r in spans) - min(r['start'] for r in spans)
+        lines.append(f"{len(tomograms)} tomograms, {wall:.1f} s wall time, {total:.1f} s in traced stages "
+                     f"(summed over all processes), peak RSS {peak_rss:.0f} MiB")
+    lines.append(f"{'stage':<14}{'seconds':>11}{'share':>8}{'spans':>8}{'MiB read':>11}{'MiB written':>13}{'MiB/s':>9}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        moved = (stage['bytes_read'] + stage['bytes_written']) / 2**20
+        rate = f"{moved / stage['seconds']:.1f}" if moved and stage['seconds'] > 0 else ''
+        share = stage['seconds'] / total if total > 0 else 0.0
+        lines.append(f"{name:<14}{stage['seconds']:>11.2f}{share:>8.1%}{stage['count']:>8}"
+                     f"{stage['bytes_read'] / 2**20:>11.1f}{stage['bytes_written'] / 2**20:>13.1f}{rate:>9}")
+    if skips:
+        lines.append('skipped:')
+        for reason, count in sorted(skips.items(), key=lambda item: -item[1]):
+            lines.append(f"  {count:>6}  {reason}")
+    if tomograms:
+        lines.append(f"slowest {min(top, len(tomograms))} tomograms:")
+        slowest = sorted(tomograms.items(), key=lambda item: -sum(item[1].values()))[:top]
+        for tomogram, times in slowest:
+            seconds = sum(times.values())
+            dominant = max(times, key=times.get)
+            lines.append(f"  {seconds:>9.2f} s  ({dominant} {times[dominant]:.2f} s)  {tomogram}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a trace written by the frame-generation scripts.')
+    parser.add_argument('trace', help='JSON-lines trace file.')
+    parser.add_argument('--chrome', default=None, help='Also write the trace in Chrome trace format to this file.')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest tomograms to list (default: 10).')
+    args = parser.parse_args()
+    spans = read_spans(args.trace)
+    print(summarize(spans, args.top))
+    if args.chrome:
+        write_chrome_trace(spans, args.chrome)